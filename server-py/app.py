@@ -1,19 +1,35 @@
+import logging
+import math
 import os
+from contextlib import asynccontextmanager
 from typing import Optional
 from pathlib import Path
 from sqlite3 import IntegrityError
 
-from fastapi import FastAPI, Depends, HTTPException, Header, Query, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import socketio
-import filetype
-import uuid
 
-from auth import hash_password, verify_password, sign_token, verify_token
+from auth import sign_token, verify_token, revoke_token, revocations, password_hasher, PasswordHasherBusy, token_cache_stats
 import db
+import metrics
+import db_async as adb
+import cluster
+import uploads
+import media
+import ratelimit
+import archive
+import wire
+
+# antes de qualquer chamada via db_async, que guarda as funções na 1ª chamada
+# (só as que consultam o banco: helpers puros e estatísticas de cache ficam de fora)
+metrics.instrument_module(db, skip={
+    "get_conn", "pool_stats", "close_pool", "init_db", "migrate",
+    "membership_stats", "history_cache_stats",
+    "room_conv_key", "dm_conv_key", "fts_query", "archive_path",
+})
 
 # =========================
 # Config
@@ -26,16 +42,44 @@ CORS_ORIGINS = os.getenv(
     "http://localhost:5173,http://localhost:8000,http://127.0.0.1:8000"
 ).split(",")
 
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", "200"))
+CATCHUP_MAX_MESSAGES = int(os.getenv("CATCHUP_MAX_MESSAGES", "500"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # se definido, /metrics exige "Bearer <token>"
+
+log = logging.getLogger(__name__)
+
 BASE_DIR = Path(__file__).parent
-UPLOAD_DIR = BASE_DIR / "uploads"
+UPLOAD_DIR = uploads.UPLOAD_DIR
 UPLOAD_DIR.mkdir(exist_ok=True)
 
 db.init_db()
 
+# Broker/presença: local (1 worker) ou Redis (BROKER_URL) para vários workers/hosts
+backend = cluster.create_backend()
+
 # =========================
 # FastAPI
 # =========================
-app = FastAPI(title="Chat API (Python)")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    metrics.loop_lag.start()
+    await backend.start(db.members_cache, revocations)
+    presence.start()
+    await adb.message_writer.start()
+    await media.media_queue.start()
+    archive.scheduler.start()
+    yield
+    await archive.scheduler.stop()
+    await media.media_queue.stop()
+    await adb.message_writer.stop()
+    await presence.stop()
+    await backend.stop()
+    await metrics.loop_lag.stop()
+    password_hasher.shutdown()
+    adb.shutdown()
+    db.close_pool()
+
+app = FastAPI(title="Chat API (Python)", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,8 +88,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.HTTPMetricsMiddleware)
 
-app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR), html=False), name="uploads")
+# /uploads: Cache-Control immutable, ETag forte, Range e cache dos arquivos quentes
+uploads_app = uploads.UploadsApp(UPLOAD_DIR)
+app.mount("/uploads", uploads_app, name="uploads")
 
 # =========================
 # Socket.IO
@@ -54,18 +101,61 @@ sio = socketio.AsyncServer(
     async_mode="asgi",
     cors_allowed_origins=[o.strip() for o in CORS_ORIGINS],
     logger=False,
-    engineio_logger=False
+    engineio_logger=False,
+    client_manager=backend.client_manager(),
 )
 socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
-ONLINE: dict[int, int] = {}
-SID_INDEX: dict[str, int] = {}  # sid -> user_id
+SID_INDEX: dict[str, int] = {}  # sid -> user_id (só os sockets deste processo)
+BINARY_SIDS: set[str] = set()   # sockets deste processo que pediram msgpack
+
+async def emit_all(event: str, data, room: Optional[str] = None):
+    """Evento JSON para todos os sockets da sala, nas duas variantes (um encode só)."""
+    await sio.emit(event, data, room=wire.all_rooms([room]) if room else None)
+
+async def emit_message(event: str, data: dict, rooms: list):
+    """Fan-out de mensagens: JSON para uns, msgpack para os que pediram.
 
-def online_count() -> int:
-    return sum(1 for v in ONLINE.values() if v > 0)
+    Um emit por formato com a lista de salas inteira: cada payload é
+    codificado uma vez, não uma por sala nem por destinatário. Sem nenhum
+    socket msgpack (em nenhum nó) a variante binária nem é publicada.
+    """
+    await sio.emit(event, data, room=rooms)
+    if wire.binary_available() and backend.binary_subscribers():
+        await sio.emit(event, wire.pack(data), room=wire.binary_rooms(rooms))
 
-async def presence_broadcast():
-    await sio.emit("presence:update", {"active": online_count()})
+async def online_count() -> int:
+    return await backend.presence.online_count()
+
+# presence:update no máximo 1x por PRESENCE_BROADCAST_INTERVAL (e presence:room, se ligado)
+presence = cluster.PresenceAggregator(backend.presence, emit_all, room_members=adb.room_member_ids)
+
+# =========================
+# Métricas
+# =========================
+FANOUT = metrics.histogram("chat_message_fanout_sockets", "Sockets locais que recebem cada message:new",
+                           ["type"], buckets=metrics.SIZE_BUCKETS)
+UPLOAD_BYTES = metrics.counter("chat_upload_bytes_total", "Bytes recebidos em /api/upload")
+_scrape = {"online": None}  # preenchido pela rota /metrics (a presença pode estar no Redis)
+metrics.gauge("chat_sockets_connected", "Sockets conectados neste processo", lambda: len(SID_INDEX))
+metrics.gauge("chat_sockets_msgpack", "Sockets deste processo recebendo mensagens em msgpack", lambda: len(BINARY_SIDS))
+metrics.gauge("chat_online_users", "Usuários online (global)", lambda: _scrape["online"])
+metrics.collector("chat_db_pool", db.pool_stats)
+metrics.collector("chat_membership_cache", db.membership_stats)
+metrics.collector("chat_history_cache", db.history_cache_stats)
+metrics.collector("chat_token_cache", token_cache_stats)
+metrics.collector("chat_password_hasher", password_hasher.stats)
+metrics.collector("chat_message_writer", adb.message_writer.stats)
+metrics.collector("chat_media_queue", media.media_queue.stats)
+metrics.collector("chat_ratelimit", ratelimit.stats)
+metrics.collector("chat_uploads_served", uploads_app.stats)
+metrics.collector("chat_archive", archive.scheduler.stats)
+metrics.collector("chat_presence", lambda: {"changes": presence.changes, "broadcasts": presence.broadcasts})
+
+def _local_sockets(room: str) -> int:
+    """Quantos sockets deste processo estão na sala (o fan-out local de um emit)."""
+    rooms = sio.manager.rooms.get("/", {})
+    return sum(len(rooms.get(r) or ()) for r in wire.all_rooms([room]))
 
 # =========================
 # Schemas
@@ -82,6 +172,18 @@ class LoginIn(BaseModel):
 class CreateRoomIn(BaseModel):
     name: str
 
+# /api/upload lê o corpo direto (sem UploadFile); só para a documentação
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"],
+        }}},
+    }
+}
+
 # =========================
 # Auth dep
 # =========================
@@ -102,6 +204,20 @@ def _ensure_join_global(user_id: int):
     if room:
         db.join_room(user_id, room["id"])
 
+def _history_page(fetch, before_id, after_id, limit):
+    """Busca `limit + 1` linhas para saber se há mais e monta o cursor seguinte.
+
+    `next_cursor` deve ser reenviado no mesmo parâmetro usado (before_id para
+    páginas mais antigas, after_id para as mais novas); None = fim.
+    """
+    rows = fetch(before_id=before_id, after_id=after_id, limit=limit + 1)
+    forward = after_id is not None and before_id is None
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit] if forward else rows[1:]
+        next_cursor = rows[-1]["id"] if forward else rows[0]["id"]
+    return {"messages": rows, "next_cursor": next_cursor}
+
 # =========================
 # Routes
 # =========================
@@ -109,13 +225,20 @@ def _ensure_join_global(user_id: int):
 def root():
     return {"service": "chat-api", "docs": "/docs"}
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(authorization: Optional[str] = Header(default=None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(401, detail="Token inválido")
+    _scrape["online"] = await online_count()
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/health")
 def health():
     return {"ok": True}
 
 @app.get("/api/active-count")
-def active_count():
-    return {"active": online_count()}
+async def active_count():
+    return {"active": await online_count()}
 
 @app.get("/api/users/find")
 def find_user_by_email(email: str = Query(..., description="Email do usuário a localizar")):
@@ -124,34 +247,30 @@ def find_user_by_email(email: str = Query(..., description="Email do usuário a
         raise HTTPException(404, detail="Usuário não encontrado")
     return {"id": u["id"], "name": u["name"], "email": u["email"]}
 
-# Upload de imagens (mensagens)
-@app.post("/api/upload")
-def upload_image(file: UploadFile = File(...), user=Depends(get_user_from_auth)):
-    orig_name = file.filename or "upload"
-    orig_ext = os.path.splitext(orig_name)[1].lower()
-    if orig_ext not in [".png", ".jpg", ".jpeg", ".gif", ".webp"]:
-        raise HTTPException(400, detail="Apenas imagens (png, jpg, jpeg, gif, webp)")
-
-    tmp_name = f"{uuid.uuid4().hex}{orig_ext or ''}"
-    dest = UPLOAD_DIR / tmp_name
-    with open(dest, "wb") as f:
-        f.write(file.file.read())
-
-    kind = filetype.guess(str(dest))
-    if not kind or not kind.mime.startswith("image/"):
-        dest.unlink(missing_ok=True)
-        raise HTTPException(400, detail="Arquivo não reconhecido como imagem")
-
-    final_ext = f".{kind.extension}" if kind.extension else orig_ext
-    final_name = f"{uuid.uuid4().hex}{final_ext}"
-    final_path = UPLOAD_DIR / final_name
-    dest.rename(final_path)
+# Upload de imagens (mensagens) — lido em streaming, com limite de tamanho
+@app.post("/api/upload", openapi_extra=UPLOAD_OPENAPI)
+async def upload_image(request: Request, user=Depends(get_user_from_auth)):
+    wait = ratelimit.upload_limiter.take(user["id"])
+    if wait:
+        raise HTTPException(429, detail="Muitos uploads, aguarde um pouco",
+                            headers={"Retry-After": str(math.ceil(wait))})
+    try:
+        saved = await uploads.receive_image(request, UPLOAD_DIR)
+    except uploads.UploadError as e:
+        raise HTTPException(e.status, detail=e.detail)
 
-    return {"url": f"/uploads/{final_name}", "type": "image", "mime": kind.mime}
+    UPLOAD_BYTES.inc(value=saved["size"])
+    stored = await uploads.store(saved)
+    if not stored["variants_done"]:
+        media.media_queue.submit(stored)  # miniatura/WebP em segundo plano
+    return {"url": stored["url"], "type": "image", "mime": stored["mime"]}
 
 # Auth / dados
+def _hasher_busy() -> HTTPException:
+    return HTTPException(503, detail="Servidor ocupado, tente novamente", headers={"Retry-After": "1"})
+
 @app.post("/api/register")
-def register(data: RegisterIn):
+async def register(data: RegisterIn):
     name = (data.name or "").strip()
     email = (data.email or "").strip().lower()
     password = (data.password or "").strip()
@@ -159,12 +278,16 @@ def register(data: RegisterIn):
         raise HTTPException(400, detail="Dados obrigatórios")
     if len(password) < 4:
         raise HTTPException(400, detail="Senha muito curta")
-    if db.find_user_by_email(email):
+    if await adb.find_user_by_email(email):
         raise HTTPException(409, detail="Email já cadastrado")
 
     try:
-        uid = db.insert_user(name, email, hash_password(password))
-        _ensure_join_global(uid)
+        password_hash = await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+    try:
+        uid = await adb.insert_user(name, email, password_hash)
+        await adb.run(_ensure_join_global, uid)
     except IntegrityError:
         raise HTTPException(409, detail="Email já cadastrado")
     except Exception:
@@ -175,18 +298,32 @@ def register(data: RegisterIn):
     return {"user": user, "token": token}
 
 @app.post("/api/login")
-def login(data: LoginIn):
+async def login(data: LoginIn):
     email = (data.email or "").strip().lower()
     password = (data.password or "").strip()
-    u = db.find_user_by_email(email)
-    if not u or not verify_password(password, u["password_hash"]):
+    u = await adb.find_user_by_email(email)
+    if not u:
         raise HTTPException(401, detail="Credenciais inválidas")
+    try:
+        ok, new_hash = await password_hasher.verify(password, u["password_hash"])
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+    if not ok:
+        raise HTTPException(401, detail="Credenciais inválidas")
+    if new_hash:
+        # custo do bcrypt mudou: grava o hash novo (já calculado no worker)
+        await adb.update_password_hash(u["id"], new_hash)
 
-    _ensure_join_global(u["id"])
+    await adb.run(_ensure_join_global, u["id"])
     user = {"id": u["id"], "name": u["name"], "email": u["email"]}
     token = sign_token(user)
     return {"user": user, "token": token}
 
+@app.post("/api/logout")
+def logout(authorization: Optional[str] = Header(default=None), user=Depends(get_user_from_auth)):
+    revoke_token(authorization[7:])
+    return {"ok": True}
+
 @app.get("/api/me")
 def me(user=Depends(get_user_from_auth)):
     return db.find_user_by_id(user["id"])
@@ -225,14 +362,42 @@ def leave_room(room_id: int, user=Depends(get_user_from_auth)):
     return {"ok": True}
 
 @app.get("/api/messages/room/{room_id}")
-def room_messages(room_id: int, user=Depends(get_user_from_auth)):
+def room_messages(
+    room_id: int,
+    before_id: Optional[int] = Query(default=None),
+    after_id: Optional[int] = Query(default=None),
+    limit: int = Query(default=db.HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_LIMIT),
+    user=Depends(get_user_from_auth),
+):
     if not db.is_member(user["id"], room_id):
         raise HTTPException(403, detail="Não é membro da sala")
-    return db.room_history(room_id)
+    return _history_page(
+        lambda **kw: db.room_history(room_id, **kw), before_id, after_id, limit
+    )
 
 @app.get("/api/messages/dm/{other_id}")
-def dm_messages(other_id: int, user=Depends(get_user_from_auth)):
-    return db.dm_history(user["id"], other_id)
+def dm_messages(
+    other_id: int,
+    before_id: Optional[int] = Query(default=None),
+    after_id: Optional[int] = Query(default=None),
+    limit: int = Query(default=db.HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_LIMIT),
+    user=Depends(get_user_from_auth),
+):
+    return _history_page(
+        lambda **kw: db.dm_history(user["id"], other_id, **kw), before_id, after_id, limit
+    )
+
+@app.get("/api/messages/search")
+def search_messages(
+    q: str = Query(..., min_length=1, max_length=200, description="Palavras a buscar"),
+    limit: int = Query(default=20, ge=1, le=HISTORY_MAX_LIMIT),
+    offset: int = Query(default=0, ge=0, le=10_000),
+    user=Depends(get_user_from_auth),
+):
+    """Busca nas salas do usuário e nas DMs dele, ordenada por relevância."""
+    rows = db.search_messages(user["id"], q, limit=limit + 1, offset=offset)
+    has_more = len(rows) > limit
+    return {"messages": rows[:limit], "next_offset": offset + limit if has_more else None}
 
 # DMs salvas
 @app.get("/api/dm/list")
@@ -254,42 +419,101 @@ def dm_remove(other_id: int, user=Depends(get_user_from_auth)):
     db.remove_dm_contact(user["id"], other_id)
     return {"ok": True}
 
+# Não lidas (mensagens novas chegam por message:new; o cliente soma localmente)
+@app.get("/api/unread")
+async def unread(user=Depends(get_user_from_auth)):
+    return await adb.unread_summary(user["id"])
+
+async def _mark_read(user_id: int, conv_key: str, conv: dict):
+    await adb.mark_read(user_id, conv_key)
+    # zera o contador nas outras abas/dispositivos do mesmo usuário
+    await emit_all("unread:update", {**conv, "unread": 0}, room=f"user:{user_id}")
+    return {"ok": True}
+
+@app.post("/api/rooms/{room_id}/read")
+async def room_read(room_id: int, user=Depends(get_user_from_auth)):
+    if not await adb.is_member(user["id"], room_id):
+        raise HTTPException(403, detail="Não é membro da sala")
+    return await _mark_read(user["id"], db.room_conv_key(room_id), {"type": "room", "id": room_id})
+
+@app.post("/api/dm/{other_id}/read")
+async def dm_read(other_id: int, user=Depends(get_user_from_auth)):
+    return await _mark_read(user["id"], db.dm_conv_key(user["id"], other_id), {"type": "dm", "id": other_id})
+
 # =========================
 # Socket.IO events
 # =========================
 @sio.event
+@metrics.socket_event("connect")
 async def connect(sid, environ, auth):
     token = (auth or {}).get("token")
     payload = verify_token(token) if token else None
     if not payload:
         return False
 
-    await sio.save_session(sid, payload)
+    # formato das mensagens deste socket: define em qual variante das salas ele entra
+    fmt = wire.negotiate(auth)
+    await sio.save_session(sid, {**payload, "fmt": fmt})
     uid = payload["id"]
     SID_INDEX[sid] = uid
-
-    ONLINE[uid] = ONLINE.get(uid, 0) + 1
-    await presence_broadcast()
-
-    await sio.enter_room(sid, f"user:{uid}")
-    for r in db.list_my_rooms(uid):
-        await sio.enter_room(sid, f"room:{r['id']}")
+    if fmt == wire.MSGPACK:
+        BINARY_SIDS.add(sid)
+        backend.set_binary_sockets(len(BINARY_SIDS))
+
+    await sio.enter_room(sid, wire.room_for(f"user:{uid}", fmt))
+    rooms = await adb.list_my_rooms(uid)
+    for r in rooms:
+        await sio.enter_room(sid, wire.room_for(f"room:{r['id']}", fmt))
+
+    if await backend.presence.add(uid):
+        presence.mark(r["id"] for r in rooms)
+
+    # reconexão: o cliente informa a última mensagem que viu e recebe o que perdeu
+    last_seen = (auth or {}).get("lastSeenId")
+    if isinstance(last_seen, int) and last_seen > 0:
+        sio.start_background_task(_catch_up, sid, uid, last_seen, fmt)
+
+async def _catch_up(sid, uid: int, last_seen: int, fmt: str = wire.JSON):
+    """Envia num único `message:batch` as mensagens perdidas enquanto offline.
+
+    Roda depois do connect (o pacote CONNECT precisa sair antes). Com mais de
+    CATCHUP_MAX_MESSAGES, `truncated` avisa o cliente para recarregar a
+    conversa aberta pelo histórico paginado.
+    """
+    try:
+        rows = await adb.missed_messages(uid, last_seen, limit=CATCHUP_MAX_MESSAGES + 1)
+        truncated = len(rows) > CATCHUP_MAX_MESSAGES
+        batch = {"messages": [wire.compact(m) for m in rows[:CATCHUP_MAX_MESSAGES]], "truncated": truncated}
+        await sio.emit("message:batch", wire.pack(batch) if fmt == wire.MSGPACK else batch, to=sid)
+    except Exception:
+        log.exception("catch-up falhou para o usuário %s", uid)
 
 @sio.event
+@metrics.socket_event("disconnect")
 async def disconnect(sid):
     sess = await sio.get_session(sid)
     uid = SID_INDEX.pop(sid, None)
-    if sess and uid is not None:
-        ONLINE[uid] = max(0, ONLINE.get(uid, 0) - 1)
-        if ONLINE[uid] == 0:
-            ONLINE.pop(uid, None)
-        await presence_broadcast()
+    if sid in BINARY_SIDS:
+        BINARY_SIDS.discard(sid)
+        backend.set_binary_sockets(len(BINARY_SIDS))
+    ratelimit.socket_limiter.forget(sid)
+    if sess and uid is not None and await backend.presence.remove(uid):
+        rooms = await adb.run(db.members_cache.user_rooms, uid) if presence.per_room else ()
+        presence.mark(rooms)
+
+def _rate_limit(sid, user_id: int) -> Optional[dict]:
+    """Ack de erro se esta conexão ou este usuário passou do limite de eventos."""
+    wait = ratelimit.take_all([(ratelimit.socket_limiter, sid), (ratelimit.user_limiter, user_id)])
+    return ratelimit.limited_ack(wait) if wait else None
 
 @sio.on("message:send")
+@metrics.socket_event("message:send")
 async def message_send(sid, payload):
     sess = await sio.get_session(sid)
     user_id = sess["id"]
-    user_name = sess["name"]
+    # antes de qualquer acesso ao banco: o cliente abusivo paga só isto
+    if (limited := _rate_limit(sid, user_id)) is not None:
+        return limited
 
     content = (payload or {}).get("content", "").strip()
     attachment_url = (payload or {}).get("attachmentUrl", None)
@@ -300,46 +524,38 @@ async def message_send(sid, payload):
 
     if payload.get("type") == "room":
         room_id = int(payload.get("roomId", 0))
-        if not db.is_member(user_id, room_id):
+        if not await adb.is_member(user_id, room_id):
             return {"ok": False, "error": "Sem acesso à sala"}
-        mid = db.insert_room_message(room_id, user_id, content or "", attachment_url, attachment_type)
-        msg = next((m for m in db.room_history(room_id) if m["id"] == mid), None) or {
-            "id": mid, "type": "room", "room_id": room_id,
-            "sender_id": user_id, "recipient_id": None,
-            "content": content or "", "created_at": "", "sender_name": user_name,
-            "attachment_url": attachment_url, "attachment_type": attachment_type
-        }
-        await sio.emit("message:new", msg, room=f"room:{room_id}")
+        msg = await adb.message_writer.insert_room_message(room_id, user_id, content or "", attachment_url, attachment_type)
+        await emit_message("message:new", wire.compact(msg), [f"room:{room_id}"])
+        FANOUT.observe(_local_sockets(f"room:{room_id}"), "room")
         return {"ok": True, "msg": msg}
 
     if payload.get("type") == "dm":
         to_user = int(payload.get("toUserId", 0))
-        if not db.find_user_by_id(to_user):
+        if not await adb.find_user_by_id(to_user):
             return {"ok": False, "error": "Usuário destino inexistente"}
-        mid = db.insert_dm(user_id, to_user, content or "", attachment_url, attachment_type)
-        history = db.dm_history(user_id, to_user)
-        msg = next((m for m in history if m["id"] == mid), None) or {
-            "id": mid, "type": "dm", "room_id": None,
-            "sender_id": user_id, "recipient_id": to_user,
-            "content": content or "", "created_at": "", "sender_name": user_name,
-            "attachment_url": attachment_url, "attachment_type": attachment_type
-        }
-        await sio.emit("message:new", msg, room=f"user:{user_id}")
-        await sio.emit("message:new", msg, room=f"user:{to_user}")
+        msg = await adb.message_writer.insert_dm(user_id, to_user, content or "", attachment_url, attachment_type)
+        # um emit só para as duas pontas (e todas as abas delas)
+        await emit_message("message:new", wire.compact(msg), [f"user:{user_id}", f"user:{to_user}"])
+        FANOUT.observe(_local_sockets(f"user:{user_id}") + _local_sockets(f"user:{to_user}"), "dm")
         return {"ok": True, "msg": msg}
 
     return {"ok": False, "error": "Tipo inválido"}
 
 @sio.on("room:leave")
+@metrics.socket_event("room:leave")
 async def room_leave(sid, payload):
     """Cliente solicita sair de uma sala: remove do DB e tira este SID da sala Socket.IO."""
     sess = await sio.get_session(sid)
     user_id = sess["id"]
+    if (limited := _rate_limit(sid, user_id)) is not None:
+        return limited
     room_id = int((payload or {}).get("roomId", 0))
-    if not db.room_exists(room_id):
+    if not await adb.room_exists(room_id):
         return {"ok": False, "error": "Sala não encontrada"}
-    db.leave_room(user_id, room_id)
-    await sio.leave_room(sid, f"room:{room_id}")
+    await adb.leave_room(user_id, room_id)
+    await sio.leave_room(sid, wire.room_for(f"room:{room_id}", sess.get("fmt", wire.JSON)))
     # opcional: avisar cliente que saiu
     await sio.emit("room:left", {"roomId": room_id}, to=sid)
     return {"ok": True}
@@ -0,0 +1,159 @@
+"""Retenção de mensagens e manutenção do SQLite.
+
+Mensagens mais antigas que RETENTION_ARCHIVE_DAYS saem do banco quente para
+um arquivo SQLite por mês (`ARCHIVE_DIR/messages-AAAA-MM.db`), que só é
+anexado quando a paginação do histórico chega nele. Com
+RETENTION_DELETE_MONTHS, meses arquivados mais velhos que isso são
+descartados. Em paralelo, VACUUM incremental e checkpoint do WAL devolvem
+ao disco o espaço que as mensagens deixaram.
+
+Roda em segundo plano no servidor (`scheduler`) ou à mão:
+
+    python archive.py run        # arquiva e descarta conforme a política
+    python archive.py maintain   # VACUUM incremental + checkpoint
+    python archive.py vacuum     # VACUUM completo (liga o auto_vacuum incremental)
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+import db
+import db_async as adb
+
+RETENTION_ARCHIVE_DAYS = int(os.getenv("RETENTION_ARCHIVE_DAYS", "0"))    # 0 = não arquiva
+RETENTION_DELETE_MONTHS = int(os.getenv("RETENTION_DELETE_MONTHS", "0"))  # 0 = guarda para sempre
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "2000"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+DB_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("DB_MAINTENANCE_INTERVAL_SECONDS", "600"))
+DB_VACUUM_PAGES = int(os.getenv("DB_VACUUM_PAGES", "2000"))
+DB_CHECKPOINT_MODE = os.getenv("DB_CHECKPOINT_MODE", "PASSIVE").upper()  # TRUNCATE encolhe o -wal, mas espera os leitores
+
+log = logging.getLogger(__name__)
+
+def archive_cutoff(days: int = RETENTION_ARCHIVE_DAYS, now: Optional[datetime] = None) -> str:
+    return ((now or datetime.utcnow()) - timedelta(days=days)).isoformat()
+
+def drop_cutoff(months: int = RETENTION_DELETE_MONTHS, now: Optional[datetime] = None) -> str:
+    """Primeiro mês ('AAAA-MM') que ainda fica; os anteriores são descartados."""
+    now = now or datetime.utcnow()
+    index = now.year * 12 + now.month - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def expired_months(months: int = RETENTION_DELETE_MONTHS) -> list:
+    if months <= 0:
+        return []
+    keep_from = drop_cutoff(months)
+    return [m for m in db.archive_months() if m < keep_from]
+
+class Scheduler:
+    """Arquivamento e manutenção periódicos, sempre no executor do banco.
+
+    O arquivamento anda em lotes de ARCHIVE_BATCH, cada um na sua transação,
+    para não segurar o lock de escrita. Com vários workers cada um roda o
+    seu; as etapas são idempotentes, então só se perde um pouco de trabalho.
+    """
+
+    def __init__(self, archive_days: int = RETENTION_ARCHIVE_DAYS, delete_months: int = RETENTION_DELETE_MONTHS,
+                 archive_interval: float = ARCHIVE_INTERVAL_SECONDS,
+                 maintenance_interval: float = DB_MAINTENANCE_INTERVAL_SECONDS):
+        self.archive_days = archive_days
+        self.delete_months = delete_months
+        self.archive_interval = archive_interval
+        self.maintenance_interval = maintenance_interval
+        self._tasks: list = []
+        self.archived = 0
+        self.dropped_months = 0
+        self.maintenance_runs = 0
+        self.freed_pages = 0
+        self.failed = 0
+        self.last_maintenance: dict = {}
+
+    async def archive_once(self) -> int:
+        moved = 0
+        if self.archive_days > 0:
+            cutoff = archive_cutoff(self.archive_days)
+            while n := await adb.archive_messages_batch(cutoff, ARCHIVE_BATCH):
+                moved += n
+                self.archived += n
+        for month in await adb.run(expired_months, self.delete_months):
+            await adb.drop_archive_month(month)
+            self.dropped_months += 1
+        return moved
+
+    async def maintain_once(self) -> dict:
+        result = await adb.maintenance(DB_VACUUM_PAGES, DB_CHECKPOINT_MODE)
+        self.maintenance_runs += 1
+        self.freed_pages += result["freed_pages"]
+        self.last_maintenance = result
+        return result
+
+    async def _every(self, interval: float, step):
+        while True:
+            try:
+                await step()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                log.warning("%s falhou", step.__name__, exc_info=True)
+            await asyncio.sleep(interval)
+
+    def start(self):
+        if self.archive_interval > 0 and (self.archive_days > 0 or self.delete_months > 0):
+            self._tasks.append(asyncio.create_task(self._every(self.archive_interval, self.archive_once)))
+        if self.maintenance_interval > 0:
+            self._tasks.append(asyncio.create_task(self._every(self.maintenance_interval, self.maintain_once)))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "archived": self.archived,
+            "dropped_months": self.dropped_months,
+            "maintenance_runs": self.maintenance_runs,
+            "freed_pages": self.freed_pages,
+            "failed": self.failed,
+            "page_count": self.last_maintenance.get("page_count"),
+            "wal_pages": self.last_maintenance.get("wal_pages"),
+        }
+
+scheduler = Scheduler()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retenção e manutenção do banco")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_run = sub.add_parser("run", help="arquiva e descarta mensagens conforme a política")
+    p_run.add_argument("--days", type=int, default=RETENTION_ARCHIVE_DAYS,
+                       help="arquiva mensagens mais antigas que isso (0 = não arquiva)")
+    p_run.add_argument("--delete-months", type=int, default=RETENTION_DELETE_MONTHS,
+                       help="descarta meses arquivados mais velhos que isso (0 = nunca)")
+    p_maint = sub.add_parser("maintain", help="VACUUM incremental + checkpoint do WAL")
+    p_maint.add_argument("--pages", type=int, default=DB_VACUUM_PAGES)
+    sub.add_parser("vacuum", help="VACUUM completo (liga o auto_vacuum incremental)")
+    args = parser.parse_args(argv)
+
+    db.init_db()
+    if args.cmd == "run":
+        moved = 0
+        if args.days > 0:
+            cutoff = archive_cutoff(args.days)
+            while n := db.archive_messages_batch(cutoff, ARCHIVE_BATCH):
+                moved += n
+        dropped = {m: db.drop_archive_month(m) for m in expired_months(args.delete_months)}
+        print(f"{moved} mensagens arquivadas; {len(dropped)} meses descartados")
+        for month, n in dropped.items():
+            print(f"  {month}: {n} mensagens")
+    elif args.cmd == "maintain":
+        print(db.maintenance(args.pages, DB_CHECKPOINT_MODE))
+    elif args.cmd == "vacuum":
+        db.vacuum_full()
+        print(db.maintenance(0, "TRUNCATE"))
+
+if __name__ == "__main__":
+    main()
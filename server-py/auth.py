@@ -1,5 +1,10 @@
 import os
 import time
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from typing import Optional, Dict
 
 from passlib.context import CryptContext
@@ -9,12 +14,22 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Hash de senha (bcrypt)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# Pool de processos para o bcrypt (fora do threadpool do Starlette)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+PASSWORD_REHASH_ON_LOGIN = os.getenv("PASSWORD_REHASH_ON_LOGIN", "0") == "1"
 
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 JWT_ALGO = "HS256"
 JWT_EXPIRES_SECONDS = int(os.getenv("JWT_EXPIRES_SECONDS", "604800"))  # 7 dias
 
+# Cache de tokens já verificados (token -> payload)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))  # segundos
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
@@ -24,6 +39,76 @@ def verify_password(plain: str, hashed: str) -> bool:
     except Exception:
         return False
 
+def _verify_and_update(plain: str, hashed: str):
+    """(ok, novo_hash | None): novo hash só quando o custo configurado mudou."""
+    try:
+        return pwd_context.verify_and_update(plain, hashed)
+    except Exception:
+        return False, None
+
+class PasswordHasherBusy(Exception):
+    """A fila do pool de hash está cheia; o cliente deve tentar de novo."""
+
+class PasswordHasher:
+    """Executa o bcrypt num pool de processos com fila limitada.
+
+    Cada chamada ocupa um slot até terminar; passando de `max_pending`
+    a requisição é recusada na hora (PasswordHasherBusy) em vez de enfileirar
+    e segurar o resto do servidor.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            return await asyncio.wrap_future(self._pool().submit(fn, *args))
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(hash_password, password)
+
+    async def verify(self, plain: str, hashed: str, rehash: bool = PASSWORD_REHASH_ON_LOGIN):
+        """(ok, novo_hash | None); com `rehash`, já devolve o hash no custo atual."""
+        if rehash:
+            return await self._submit(_verify_and_update, plain, hashed)
+        return await self._submit(verify_password, plain, hashed), None
+
+    def stats(self) -> Dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "peak_pending": self.peak_pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher()
+
 def sign_token(user: Dict) -> str:
     payload = {
         "id": user["id"],
@@ -34,11 +119,141 @@ def sign_token(user: Dict) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGO)
 
+class TokenCache:
+    """LRU com TTL de tokens já verificados; nunca serve um token além do `exp`."""
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE, ttl: int = TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # token -> (expira_em, payload)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str, now: float) -> Optional[Dict]:
+        with self._lock:
+            item = self._items.get(token)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._items[token]
+                self.misses += 1
+                return None
+            self._items.move_to_end(token)
+            self.hits += 1
+            return item[1]
+
+    def put(self, token: str, payload: Dict, exp: float, now: float):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[token] = (min(exp, now + self.ttl), payload)
+            self._items.move_to_end(token)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def discard(self, token: str):
+        with self._lock:
+            self._items.pop(token, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+_token_cache = TokenCache()
+
+def token_hash(token: str) -> str:
+    """Identificador de um token revogado: o SHA-256, nunca o JWT em si."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class RevocationList:
+    """Tokens revogados (hash -> exp); cada um some sozinho depois que expiraria.
+
+    Guarda só o `token_hash`, e é só ele que os observadores (`subscribe`)
+    recebem para propagar a revogação aos outros processos (ver
+    `cluster.RedisBackend`), que a aplicam com `add(..., notify=False)`.
+    """
+
+    def __init__(self, cache: TokenCache):
+        self._cache = cache
+        self._items: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._listeners: list = []
+
+    def subscribe(self, fn):
+        self._listeners.append(fn)
+
+    def unsubscribe(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def is_revoked(self, token: str, now: float) -> bool:
+        if not self._items:
+            return False
+        digest = token_hash(token)
+        with self._lock:
+            exp = self._items.get(digest)
+            if exp is not None and exp <= now:
+                del self._items[digest]
+                return False
+            return exp is not None
+
+    def revoke(self, token: str, exp: float):
+        self._cache.discard(token)
+        self.add(token_hash(token), exp)
+
+    def add(self, digest: str, exp: float, notify: bool = True):
+        now = time.time()
+        if exp <= now:
+            return
+        with self._lock:
+            for d in [d for d, e in self._items.items() if e <= now]:
+                del self._items[d]
+            self._items[digest] = exp
+        if notify:
+            for fn in self._listeners:
+                fn(digest, exp)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+revocations = RevocationList(_token_cache)
+
+def revoke_token(token: Optional[str]):
+    """Invalida um token antes do `exp` (ex.: logout).
+
+    Com BROKER_URL a revogação é publicada no Redis e vale em todos os nós;
+    sem ele, só neste processo.
+    """
+    if not token:
+        return
+    try:
+        data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
+    except Exception:
+        return  # inválido/expirado: já não passa na verificação
+    revocations.revoke(token, data.get("exp", time.time() + JWT_EXPIRES_SECONDS))
+
+def token_cache_stats() -> Dict:
+    return {**_token_cache.stats(), "revoked": len(revocations)}
+
 def verify_token(token: Optional[str]) -> Optional[Dict]:
     if not token:
         return None
+    now = time.time()
+    if revocations.is_revoked(token, now):
+        return None
+    cached = _token_cache.get(token, now)
+    if cached is not None:
+        return dict(cached)
     try:
         data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
-        return {"id": data["id"], "name": data["name"], "email": data["email"]}
+        payload = {"id": data["id"], "name": data["name"], "email": data["email"]}
     except Exception:
         return None
+    _token_cache.put(token, payload, data.get("exp", now + TOKEN_CACHE_TTL), now)
+    return dict(payload)
@@ -0,0 +1,403 @@
+"""Benchmark reprodutível dos caminhos REST e Socket.IO.
+
+Cria um banco sintético (usuários, salas, mensagens) num diretório
+temporário, sobe o `socket_app` num uvicorn dentro do próprio processo e
+mede, com vários clientes simultâneos:
+
+- login            POST /api/login (bcrypt no pool de processos)
+- history          GET  /api/messages/room/{id} e /api/messages/dm/{id}
+- room_send        ack do message:send numa sala + entrega (fan-out) aos membros
+- dm_send          ack do message:send numa DM + entrega ao destinatário
+
+Os resultados (p50/p90/p99/max em ms e vazão) vão para um JSON que pode ser
+comparado entre execuções:
+
+    python bench.py run --out antes.json
+    python bench.py run --out depois.json --messages 200000
+    python bench.py compare antes.json depois.json --threshold 10
+
+Precisa de `httpx` e `aiohttp` (cliente Socket.IO), além das dependências do
+servidor. Os limites de taxa ficam desligados, a menos que `--keep-rate-limits`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BENCH_PASSWORD = "bench-pass"
+
+# =========================
+# Estatística
+# =========================
+def percentile(sorted_values: list, p: float) -> float:
+    """Percentil por posição (nearest-rank) de uma lista já ordenada."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+def summarize(latencies: list, errors: int, elapsed: float, **extra) -> dict:
+    ms = sorted(x * 1000 for x in latencies)
+    return {
+        "count": len(ms),
+        "errors": errors,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p90_ms": round(percentile(ms, 90), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(ms[-1], 3) if ms else 0.0,
+        "throughput_per_s": round(len(ms) / elapsed, 1) if elapsed > 0 else 0.0,
+        **extra,
+    }
+
+# =========================
+# Banco sintético
+# =========================
+def seed(users: int, rooms: int, messages: int, rooms_per_user: int, dm_share: float, rng: random.Random) -> dict:
+    """Popula o banco de CHAT_DB_PATH (migrações + inserts em lote numa transação)."""
+    import db
+    from auth import pwd_context
+
+    db.init_db()
+    password_hash = pwd_context.hash(BENCH_PASSWORD)  # um hash só: o custo do login continua o real
+    now = datetime.utcnow()
+    with db.get_conn() as c:
+        geral = c.execute("SELECT id FROM rooms WHERE name = 'Geral'").fetchone()[0]
+        c.executemany(
+            "INSERT INTO users (name, email, password_hash, created_at) VALUES (?, ?, ?, ?)",
+            [(f"user{i}", f"user{i}@bench.local", password_hash, now.isoformat()) for i in range(users)],
+        )
+        user_ids = [r[0] for r in c.execute("SELECT id FROM users WHERE email LIKE '%@bench.local' ORDER BY id")]
+        c.executemany(
+            "INSERT INTO rooms (name, created_at) VALUES (?, ?)",
+            [(f"bench-{i}", now.isoformat()) for i in range(rooms)],
+        )
+        room_ids = [r[0] for r in c.execute("SELECT id FROM rooms WHERE name LIKE 'bench-%' ORDER BY id")]
+
+        members = {rid: [] for rid in [geral] + room_ids}
+        pairs = []
+        for uid in user_ids:
+            for rid in [geral] + rng.sample(room_ids, min(rooms_per_user, len(room_ids))):
+                members[rid].append(uid)
+                pairs.append((uid, rid))
+        c.executemany("INSERT OR IGNORE INTO room_members (user_id, room_id) VALUES (?, ?)", pairs)
+
+        # mensagens espalhadas no tempo, com salas populares (distribuição enviesada)
+        room_pool = [rid for rid, uids in members.items() if uids]
+        weights = [1 / (i + 1) for i in range(len(room_pool))]
+        rows = []
+        for i in range(messages):
+            created = (now - timedelta(seconds=messages - i)).isoformat()
+            if rng.random() < dm_share and len(user_ids) > 1:
+                a, b = rng.sample(user_ids, 2)
+                rows.append(("dm", None, a, b, f"dm {i} " + rng.choice(WORDS), created))
+            else:
+                rid = rng.choices(room_pool, weights)[0]
+                rows.append(("room", rid, rng.choice(members[rid]), None, f"msg {i} " + rng.choice(WORDS), created))
+        c.executemany(
+            "INSERT INTO messages (type, room_id, sender_id, recipient_id, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    db.members_cache.clear()
+    return {"geral": geral, "user_ids": user_ids, "room_ids": room_ids, "members": members}
+
+WORDS = [
+    "bom dia pessoal", "alguém viu o deploy?", "reunião às 10h", "vou almoçar", "PR aprovado",
+    "o build quebrou de novo", "obrigado!", "segue o link da doc", "já volto", "boa noite",
+]
+
+# =========================
+# Servidor no mesmo processo
+# =========================
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port: int):
+    """Sobe `app.socket_app` num uvicorn em outra thread (com lifespan)."""
+    import uvicorn
+    import app
+
+    server = uvicorn.Server(uvicorn.Config(app.socket_app, host="127.0.0.1", port=port,
+                                           log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline or not thread.is_alive():
+            raise RuntimeError("servidor não subiu")
+        time.sleep(0.05)
+    return server, thread
+
+# =========================
+# Cenários
+# =========================
+async def _gather_limited(n: int, concurrency: int, fn):
+    """Roda fn(i) para i em range(n) com no máximo `concurrency` ao mesmo tempo."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            return await fn(i)
+    return await asyncio.gather(*(one(i) for i in range(n)))
+
+async def bench_login(http, n: int, concurrency: int, user_count: int) -> tuple:
+    latencies, errors, tokens = [], 0, {}
+
+    async def one(i):
+        nonlocal errors
+        email = f"user{i % user_count}@bench.local"
+        t0 = time.perf_counter()
+        r = await http.post("/api/login", json={"email": email, "password": BENCH_PASSWORD})
+        if r.status_code != 200:
+            errors += 1
+            return
+        latencies.append(time.perf_counter() - t0)
+        body = r.json()
+        tokens[body["user"]["id"]] = body["token"]
+
+    start = time.perf_counter()
+    await _gather_limited(n, concurrency, one)
+    return summarize(latencies, errors, time.perf_counter() - start), tokens
+
+async def bench_history(http, n: int, concurrency: int, data: dict, tokens: dict, rng: random.Random) -> dict:
+    latencies, errors = [], 0
+    members = {rid: [u for u in uids if u in tokens] for rid, uids in data["members"].items()}
+    rooms = [rid for rid, uids in members.items() if uids]
+    users = list(tokens)
+
+    async def one(i):
+        nonlocal errors
+        if i % 4 == 3:  # 1 em cada 4: histórico de DM
+            me, other = rng.sample(users, 2)
+            path = f"/api/messages/dm/{other}"
+        else:
+            rid = rng.choice(rooms)
+            me = rng.choice(members[rid])
+            path = f"/api/messages/room/{rid}"
+        t0 = time.perf_counter()
+        r = await http.get(path, headers={"Authorization": f"Bearer {tokens[me]}"})
+        if r.status_code != 200:
+            errors += 1
+            return
+        latencies.append(time.perf_counter() - t0)
+
+    start = time.perf_counter()
+    await _gather_limited(n, concurrency, one)
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+class SocketFleet:
+    """Clientes Socket.IO simulados; registra quando cada mensagem marcada chega."""
+
+    def __init__(self, base: str):
+        self.base = base
+        self.clients = {}  # user_id -> AsyncClient
+        self.sent_at = {}  # marca -> perf_counter do envio
+        self.deliveries = []
+
+    async def connect(self, tokens: dict, concurrency: int = 20):
+        import socketio
+
+        async def one(uid):
+            client = socketio.AsyncClient(reconnection=False)
+            client.on("message:new", self._on_message)
+            await client.connect(self.base, auth={"token": tokens[uid]}, transports=["websocket"])
+            self.clients[uid] = client
+
+        uids = list(tokens)
+        await _gather_limited(len(uids), concurrency, lambda i: one(uids[i]))
+
+    async def _on_message(self, msg):
+        sent = self.sent_at.get((msg.get("content") or "").split(" ", 1)[0])
+        if sent is not None:
+            self.deliveries.append(time.perf_counter() - sent)
+
+    async def send(self, uid: int, payload: dict, tag: str) -> float:
+        payload = {**payload, "content": f"{tag} benchmark"}
+        t0 = self.sent_at[tag] = time.perf_counter()
+        ack = await self.clients[uid].call("message:send", payload, timeout=30)
+        if not ack or not ack.get("ok"):
+            raise RuntimeError(ack)
+        return time.perf_counter() - t0
+
+    async def close(self):
+        await asyncio.gather(*(c.disconnect() for c in self.clients.values()), return_exceptions=True)
+
+async def bench_send(fleet: SocketFleet, kind: str, per_client: int, room_id: int, rng: random.Random,
+                     settle: float = 1.0) -> dict:
+    """Cada cliente envia `per_client` mensagens (sala `room_id` ou DMs aleatórias), em paralelo."""
+    fleet.deliveries = []
+    latencies, errors = [], 0
+    uids = list(fleet.clients)
+
+    async def client_loop(uid):
+        nonlocal errors
+        for seq in range(per_client):
+            if kind == "room":
+                payload = {"type": "room", "roomId": room_id}
+            else:
+                payload = {"type": "dm", "toUserId": rng.choice([u for u in uids if u != uid])}
+            try:
+                latencies.append(await fleet.send(uid, payload, f"{kind}:{uid}:{seq}"))
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop(uid) for uid in uids))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(settle)  # deixa as últimas entregas chegarem
+    deliveries = sorted(x * 1000 for x in fleet.deliveries)
+    return summarize(
+        latencies, errors, elapsed,
+        deliveries=len(deliveries),
+        delivery_p50_ms=round(percentile(deliveries, 50), 3),
+        delivery_p99_ms=round(percentile(deliveries, 99), 3),
+        deliveries_per_s=round(len(deliveries) / elapsed, 1) if elapsed > 0 else 0.0,
+    )
+
+# =========================
+# Execução
+# =========================
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+async def _run_scenarios(args, data: dict, port: int) -> dict:
+    import httpx
+
+    rng = random.Random(args.seed + 1)
+    base = f"http://127.0.0.1:{port}"
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base, timeout=60, limits=limits) as http:
+        print(f"[bench] login x{args.logins}")
+        results["login"], tokens = await bench_login(http, args.logins, args.concurrency, args.users)
+        print(f"[bench] history x{args.history}")
+        results["history"] = await bench_history(http, args.history, args.concurrency, data, tokens, rng)
+
+    fleet = SocketFleet(base)
+    wanted = dict(list(tokens.items())[:args.clients])
+    print(f"[bench] conectando {len(wanted)} sockets")
+    try:
+        t0 = time.perf_counter()
+        await fleet.connect(wanted)
+        results["socket_connect"] = {"clients": len(fleet.clients),
+                                     "seconds": round(time.perf_counter() - t0, 3)}
+        print(f"[bench] room_send {len(fleet.clients)} x {args.sends}")
+        results["room_send"] = await bench_send(fleet, "room", args.sends, data["geral"], rng)
+        print(f"[bench] dm_send {len(fleet.clients)} x {args.sends}")
+        results["dm_send"] = await bench_send(fleet, "dm", args.sends, data["geral"], rng)
+    finally:
+        await fleet.close()
+    return results
+
+def cmd_run(args):
+    work = Path(tempfile.mkdtemp(prefix="chat-bench-"))
+    # o banco e os limites precisam estar no ambiente antes de importar db/app
+    os.environ["CHAT_DB_PATH"] = str(work / "chat.db")
+    os.environ["UPLOAD_DIR"] = str(work / "uploads")
+    if not args.keep_rate_limits:
+        for name in ("RATE_SOCKET_PER_SEC", "RATE_USER_PER_SEC", "RATE_UPLOAD_PER_SEC"):
+            os.environ[name] = "0"
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    rng = random.Random(args.seed)
+    print(f"[bench] semeando {args.users} usuários, {args.rooms} salas, {args.messages} mensagens em {work}")
+    t0 = time.perf_counter()
+    data = seed(args.users, args.rooms, args.messages, args.rooms_per_user, args.dm_share, rng)
+    seed_seconds = time.perf_counter() - t0
+
+    port = free_port()
+    server, thread = start_server(port)
+    try:
+        results = asyncio.run(_run_scenarios(args, data, port))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed_seconds": round(seed_seconds, 2),
+            "params": {k: v for k, v in vars(args).items() if k not in ("func", "out")},
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+        print(f"[bench] resultados em {args.out}")
+    print(text)
+
+# métricas em que maior é melhor; nas demais (latências), maior é pior
+_HIGHER_IS_BETTER = {"throughput_per_s", "deliveries_per_s"}
+_COMPARED = ("p50_ms", "p99_ms", "throughput_per_s", "delivery_p50_ms", "delivery_p99_ms", "deliveries_per_s")
+
+def cmd_compare(args):
+    old = json.loads(Path(args.old).read_text(encoding="utf-8"))["results"]
+    new = json.loads(Path(args.new).read_text(encoding="utf-8"))["results"]
+    regressions = 0
+    print(f"{'cenário':<16}{'métrica':<20}{'antes':>12}{'depois':>12}{'Δ%':>9}")
+    for scenario in sorted(set(old) & set(new)):
+        for metric in _COMPARED:
+            a, b = old[scenario].get(metric), new[scenario].get(metric)
+            if a is None or b is None:
+                continue
+            delta = ((b - a) / a * 100) if a else 0.0
+            worse = -delta if metric in _HIGHER_IS_BETTER else delta
+            flag = ""
+            if worse > args.threshold:
+                flag = "  << regressão"
+                regressions += 1
+            print(f"{scenario:<16}{metric:<20}{a:>12.2f}{b:>12.2f}{delta:>+9.1f}{flag}")
+    if regressions:
+        print(f"\n{regressions} métrica(s) piores que {args.threshold}%")
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do chat (REST + Socket.IO)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="semeia um banco sintético e mede os cenários")
+    run.add_argument("--users", type=int, default=200)
+    run.add_argument("--rooms", type=int, default=20)
+    run.add_argument("--messages", type=int, default=20_000)
+    run.add_argument("--rooms-per-user", type=int, default=3)
+    run.add_argument("--dm-share", type=float, default=0.2, help="fração das mensagens semeadas que são DMs")
+    run.add_argument("--logins", type=int, default=200)
+    run.add_argument("--history", type=int, default=1000, help="requisições de histórico")
+    run.add_argument("--concurrency", type=int, default=20, help="requisições HTTP simultâneas")
+    run.add_argument("--clients", type=int, default=50, help="sockets simultâneos")
+    run.add_argument("--sends", type=int, default=20, help="mensagens enviadas por socket em cada cenário")
+    run.add_argument("--seed", type=int, default=42)
+    run.add_argument("--keep-rate-limits", action="store_true")
+    run.add_argument("--out", help="arquivo JSON de saída")
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser("compare", help="compara dois JSON de resultados")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=10.0, help="piora máxima tolerada, em %%")
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""Caches em memória (por processo): salas/associações e histórico recente.
+
+`MembershipCache` guarda salas e associações usuário↔sala;
+`HistoryCache` guarda as últimas mensagens das conversas ativas.
+
+Os dados vêm sempre do SQLite (via loaders passados por `db.py`) e o cache é
+mantido em dia pelas próprias funções de escrita de `db.py` (join/leave/create).
+Leituras concorrentes com uma escrita nunca gravam um conjunto velho: cada
+carga só é guardada se nenhuma invalidação aconteceu enquanto ela rodava.
+Os conjuntos são frozensets trocados a cada escrita, então quem os recebe
+pode iterar sem lock. Com vários nós, `cluster.py` assina as mudanças
+(`subscribe`) e invalida as entradas correspondentes nos outros processos.
+"""
+import sys
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+class MembershipCache:
+    def __init__(
+        self,
+        load_user_rooms: Callable[[int], Iterable[int]],
+        load_room_members: Callable[[int], Iterable[int]],
+        load_rooms: Callable[[], Iterable[tuple]],
+        max_users: int = 100_000,
+        max_rooms: int = 10_000,
+    ):
+        self._load_user_rooms = load_user_rooms
+        self._load_room_members = load_room_members
+        self._load_rooms = load_rooms
+        self.max_users = max_users
+        self.max_rooms = max_rooms
+
+        self._lock = threading.Lock()
+        self._gen = 0  # incrementa a cada invalidação
+        self._user_rooms: "OrderedDict[int, frozenset]" = OrderedDict()
+        self._room_members: "OrderedDict[int, frozenset]" = OrderedDict()
+        self._room_index: Optional[tuple] = None  # (id -> nome, nome -> id)
+        self.hits = 0
+        self.misses = 0
+        self._listeners: list = []
+
+    # ---------- observadores (ex.: propagar invalidações para outros nós) ----------
+    def subscribe(self, fn: Callable[[str, Optional[int], Optional[int]], None]):
+        self._listeners.append(fn)
+
+    def unsubscribe(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def _notify(self, event: str, user_id: Optional[int], room_id: Optional[int]):
+        for fn in self._listeners:
+            fn(event, user_id, room_id)
+
+    # ---------- leitura ----------
+    def _get(self, table: OrderedDict, key: int, loader, limit: int) -> frozenset:
+        with self._lock:
+            found = table.get(key)
+            if found is not None:
+                table.move_to_end(key)
+                self.hits += 1
+                return found
+            self.misses += 1
+            gen = self._gen
+        loaded = frozenset(loader(key))
+        with self._lock:
+            if gen == self._gen:
+                table[key] = loaded
+                if len(table) > limit:
+                    table.popitem(last=False)
+        return loaded
+
+    def user_rooms(self, user_id: int) -> frozenset:
+        return self._get(self._user_rooms, user_id, self._load_user_rooms, self.max_users)
+
+    def room_members(self, room_id: int) -> frozenset:
+        return self._get(self._room_members, room_id, self._load_room_members, self.max_rooms)
+
+    def is_member(self, user_id: int, room_id: int) -> bool:
+        return room_id in self.user_rooms(user_id)
+
+    def _rooms(self) -> tuple:
+        """(id -> nome, nome -> id) de todas as salas."""
+        with self._lock:
+            snapshot = self._room_index
+            if snapshot is not None:
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+            gen = self._gen
+        names = {rid: name for rid, name in self._load_rooms()}
+        snapshot = (names, {name: rid for rid, name in names.items()})
+        with self._lock:
+            if gen == self._gen:
+                self._room_index = snapshot
+        return snapshot
+
+    def room_names(self) -> dict:
+        return self._rooms()[0]
+
+    def room_name(self, room_id: int) -> Optional[str]:
+        return self._rooms()[0].get(room_id)
+
+    def room_id_by_name(self, name: str) -> Optional[int]:
+        return self._rooms()[1].get(name)
+
+    # ---------- invalidação ----------
+    def on_join(self, user_id: int, room_id: int):
+        with self._lock:
+            self._gen += 1
+            if user_id in self._user_rooms:
+                self._user_rooms[user_id] = self._user_rooms[user_id] | {room_id}
+            if room_id in self._room_members:
+                self._room_members[room_id] = self._room_members[room_id] | {user_id}
+        self._notify("join", user_id, room_id)
+
+    def on_leave(self, user_id: int, room_id: int):
+        with self._lock:
+            self._gen += 1
+            if user_id in self._user_rooms:
+                self._user_rooms[user_id] = self._user_rooms[user_id] - {room_id}
+            if room_id in self._room_members:
+                self._room_members[room_id] = self._room_members[room_id] - {user_id}
+        self._notify("leave", user_id, room_id)
+
+    def on_room_created(self, room_id: int, name: str):
+        with self._lock:
+            self._gen += 1
+            if self._room_index is not None:
+                names, ids = self._room_index
+                self._room_index = ({**names, room_id: name}, {**ids, name: room_id})
+        self._notify("room_created", None, room_id)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._gen += 1
+            self._user_rooms.pop(user_id, None)
+
+    def invalidate_room(self, room_id: int):
+        with self._lock:
+            self._gen += 1
+            self._room_members.pop(room_id, None)
+
+    def invalidate_rooms(self):
+        with self._lock:
+            self._gen += 1
+            self._room_index = None
+
+    def clear(self):
+        with self._lock:
+            self._gen += 1
+            self._user_rooms.clear()
+            self._room_members.clear()
+            self._room_index = None
+
+    # ---------- estatísticas ----------
+    def _approx_bytes(self) -> int:
+        size = sys.getsizeof(self._user_rooms) + sys.getsizeof(self._room_members)
+        for table in (self._user_rooms, self._room_members):
+            for key, members in table.items():
+                size += sys.getsizeof(key) + sys.getsizeof(members)
+        if self._room_index is not None:
+            names, ids = self._room_index
+            size += sys.getsizeof(names) + sys.getsizeof(ids)
+            size += sum(sys.getsizeof(n) for n in names.values())
+        return size
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "users": len(self._user_rooms),
+                "rooms": len(self._room_members),
+                "room_names": len(self._room_index[0]) if self._room_index else 0,
+                "approx_bytes": self._approx_bytes(),
+            }
+
+class _Ring:
+    __slots__ = ("ids", "msgs", "bytes", "whole")
+
+    def __init__(self):
+        self.ids: list = []
+        self.msgs: list = []
+        self.bytes = 0
+        self.whole = False  # True = contém a conversa inteira (nada mais antigo no banco)
+
+def _approx_size(msg: dict) -> int:
+    return sys.getsizeof(msg) + sum(sys.getsizeof(v) for v in msg.values())
+
+class HistoryCache:
+    """Últimas `per_conv` mensagens de cada conversa ativa, em ordem de id.
+
+    Cada buffer é um sufixo contíguo da conversa: carregado do SQLite na
+    primeira leitura e depois alimentado pelos INSERTs (`add`). Páginas que
+    cabem no buffer saem daqui sem tocar o banco; as mais antigas voltam
+    `None` e o chamador vai ao SQLite. As conversas menos usadas saem (LRU)
+    quando o total passa de `max_bytes`.
+
+    Os dicts devolvidos são compartilhados: não altere.
+    """
+
+    def __init__(self, per_conv: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.per_conv = per_conv
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._convs: "OrderedDict[str, _Ring]" = OrderedDict()
+        self._loading: dict = {}  # chave -> mensagens inseridas enquanto o buffer carrega
+        self._by_attachment: dict = {}  # url do anexo -> chaves que o citam
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- leitura ----------
+    def get(self, key: str, before_id=None, after_id=None, limit: int = 50) -> Optional[list]:
+        """Mesma página que `db._history` devolveria, ou None se o buffer não cobre."""
+        with self._lock:
+            ring = self._convs.get(key)
+            rows = None
+            if ring is not None and (before_id is None or after_id is None):
+                ids = ring.ids
+                if after_id is not None:
+                    # ids são globais: só dá para garantir que nada falta a partir do 1º do buffer
+                    if ring.whole or (ids and after_id >= ids[0]):
+                        start = bisect_right(ids, after_id)
+                        rows = ring.msgs[start:start + limit]
+                else:
+                    end = len(ids) if before_id is None else bisect_left(ids, before_id)
+                    start = max(0, end - limit)
+                    if end - start == limit or ring.whole:
+                        rows = ring.msgs[start:end]
+            if rows is None:
+                self.misses += 1
+                return None
+            self._convs.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._convs
+
+    # ---------- carga ----------
+    def begin_load(self, key: str) -> bool:
+        """Reserva a carga de `key`; False se já está no cache ou carregando."""
+        with self._lock:
+            if key in self._convs or key in self._loading:
+                return False
+            self._loading[key] = []
+            return True
+
+    def abort_load(self, key: str):
+        with self._lock:
+            self._loading.pop(key, None)
+
+    def install(self, key: str, rows: list):
+        """Instala as `rows` mais recentes (em ordem) lidas do banco após `begin_load`.
+
+        INSERTs que chegaram durante a leitura entram também (sem duplicar).
+        """
+        with self._lock:
+            pending = self._loading.pop(key, None)
+            if pending is None:  # invalidado durante a carga
+                return
+            ring = _Ring()
+            ring.whole = len(rows) < self.per_conv
+            self._convs[key] = ring
+            for msg in rows:
+                self._append(key, ring, msg)
+            for msg in pending:
+                self._append(key, ring, msg)
+            self._trim(key, ring)
+            self._enforce_budget(keep=key)
+
+    # ---------- escrita ----------
+    def add(self, key: str, msg: dict):
+        """Mensagem recém-gravada (chamado depois do commit)."""
+        with self._lock:
+            ring = self._convs.get(key)
+            if ring is None:
+                pending = self._loading.get(key)
+                if pending is not None:
+                    pending.append(msg)
+                return
+            self._append(key, ring, msg)
+            self._trim(key, ring)
+            self._convs.move_to_end(key)
+            self._enforce_budget(keep=key)
+
+    def _append(self, key: str, ring: _Ring, msg: dict):
+        mid = msg["id"]
+        if ring.ids and mid <= ring.ids[-1]:
+            i = bisect_left(ring.ids, mid)
+            if i < len(ring.ids) and ring.ids[i] == mid:
+                return  # já está (carga + INSERT concorrente)
+            insort(ring.ids, mid)
+            ring.msgs.insert(i, msg)
+        else:
+            ring.ids.append(mid)
+            ring.msgs.append(msg)
+        size = _approx_size(msg)
+        ring.bytes += size
+        self.bytes += size
+        if msg.get("attachment_url"):
+            self._by_attachment.setdefault(msg["attachment_url"], set()).add(key)
+
+    def _trim(self, key: str, ring: _Ring):
+        extra = len(ring.ids) - self.per_conv
+        if extra <= 0:
+            return
+        removed = ring.msgs[:extra]
+        freed = sum(_approx_size(m) for m in removed)
+        del ring.ids[:extra]
+        del ring.msgs[:extra]
+        ring.bytes -= freed
+        self.bytes -= freed
+        ring.whole = False
+        self._unindex(key, removed, ring.msgs)
+
+    def _unindex(self, key: str, removed: list, remaining: list):
+        for url in {m["attachment_url"] for m in removed if m.get("attachment_url")}:
+            keys = self._by_attachment.get(url)
+            if keys is None or any(m.get("attachment_url") == url for m in remaining):
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._by_attachment[url]
+
+    def _enforce_budget(self, keep: Optional[str]):
+        while self.bytes > self.max_bytes and len(self._convs) > 1:
+            key, ring = next(iter(self._convs.items()))
+            if key == keep:
+                self._convs.move_to_end(key)
+                continue
+            self._drop(key)
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        ring = self._convs.pop(key, None)
+        if ring is not None:
+            self.bytes -= ring.bytes
+            self._unindex(key, ring.msgs, ())
+
+    def on_attachment_variants(self, url: str, thumb_url: Optional[str], webp_url: Optional[str]):
+        """Miniatura/WebP ficaram prontos: atualiza as mensagens em cache que usam `url`."""
+        with self._lock:
+            for key in self._by_attachment.pop(url, ()):
+                ring = self._convs.get(key)
+                if ring is None:
+                    continue
+                for i, msg in enumerate(ring.msgs):
+                    if msg.get("attachment_url") == url:
+                        # cópia nova: quem já recebeu o dict antigo não o vê mudar
+                        new = {**msg, "attachment_thumb_url": thumb_url, "attachment_webp_url": webp_url}
+                        delta = _approx_size(new) - _approx_size(msg)
+                        ring.msgs[i] = new
+                        ring.bytes += delta
+                        self.bytes += delta
+            self._enforce_budget(None)
+
+    # ---------- invalidação ----------
+    def invalidate(self, key: str):
+        with self._lock:
+            self._drop(key)
+            self._loading.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._convs.clear()
+            self._loading.clear()
+            self._by_attachment.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "conversations": len(self._convs),
+                "messages": sum(len(r.ids) for r in self._convs.values()),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,632 @@
+"""Backends plugáveis para rodar mais de um worker/host.
+
+`BROKER_URL` vazio usa o backend local: manager do Socket.IO em processo,
+presença num dict e nenhuma propagação de cache (um worker só; testes).
+`BROKER_URL=redis://...` usa o Redis (ou qualquer servidor compatível com o
+protocolo) para três coisas:
+
+- fan-out do Socket.IO (`AsyncRedisManager`): `sio.emit` chega a todos os nós;
+- presença global: contagem de conexões por usuário + total online em O(1);
+- invalidação do cache de membros (`cache.MembershipCache`) e revogação de
+  tokens (`auth.RevocationList`) entre os nós.
+
+Cada nó registra um heartbeat; se um nó morre sem desconectar seus sockets,
+outro nó desconta as conexões dele da presença global.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Iterable, Optional
+
+import socketio
+
+BROKER_URL = os.getenv("BROKER_URL", "").strip()
+BROKER_PREFIX = os.getenv("BROKER_PREFIX", "chat")
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+NODE_HEARTBEAT_SECONDS = float(os.getenv("NODE_HEARTBEAT_SECONDS", "10"))
+PRESENCE_BROADCAST_INTERVAL = float(os.getenv("PRESENCE_BROADCAST_INTERVAL", "1.0"))
+PRESENCE_PER_ROOM = os.getenv("PRESENCE_PER_ROOM", "0") == "1"
+LISTENER_RETRY_SECONDS = float(os.getenv("LISTENER_RETRY_SECONDS", "0.5"))
+LISTENER_RETRY_MAX_SECONDS = float(os.getenv("LISTENER_RETRY_MAX_SECONDS", "30"))
+
+log = logging.getLogger(__name__)
+
+# =========================
+# Presença
+# =========================
+class LocalPresenceStore:
+    """Conexões por usuário na memória do processo."""
+
+    shared = False  # a contagem é só deste processo: ele mesmo a anuncia
+
+    def __init__(self):
+        self._conns: dict[int, int] = {}
+
+    async def add(self, uid: int) -> bool:
+        """Registra uma conexão; True se o usuário acabou de ficar online."""
+        n = self._conns.get(uid, 0) + 1
+        self._conns[uid] = n
+        return n == 1
+
+    async def remove(self, uid: int) -> bool:
+        """Remove uma conexão; True se o usuário acabou de ficar offline."""
+        n = self._conns.get(uid, 0) - 1
+        if n > 0:
+            self._conns[uid] = n
+            return False
+        return self._conns.pop(uid, None) is not None
+
+    async def online_count(self) -> int:
+        return len(self._conns)
+
+    async def online_among(self, uids: Iterable[int]) -> int:
+        return sum(1 for uid in uids if uid in self._conns)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+# Cada script roda atômico no Redis: nenhum nó vê o hash `users` e o
+# contador `online` fora de sincronia, nem desconta um nó que ainda vive.
+_ADD_LUA = """
+local total = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+if total == 1 then redis.call('INCR', KEYS[3]) end
+return total
+"""
+
+# -1: este nó já foi descontado pelo reaper, não há o que devolver
+_REMOVE_LUA = """
+local mine = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+if mine <= 0 then return -1 end
+if mine == 1 then
+  redis.call('HDEL', KEYS[2], ARGV[1])
+else
+  redis.call('HINCRBY', KEYS[2], ARGV[1], -1)
+end
+local total = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if total <= 0 then
+  redis.call('HDEL', KEYS[1], ARGV[1])
+  if total == 0 then redis.call('DECR', KEYS[3]) end
+end
+return total
+"""
+
+# sem ARGV[2] == '1', não mexe em nó com heartbeat em dia (-1)
+_SUBTRACT_LUA = """
+if ARGV[2] ~= '1' and redis.call('EXISTS', KEYS[5]) == 1 then return -1 end
+local counts = redis.call('HGETALL', KEYS[2])
+local gone = 0
+for i = 1, #counts, 2 do
+  local n = tonumber(counts[i + 1])
+  if n > 0 then
+    local total = redis.call('HINCRBY', KEYS[1], counts[i], -n)
+    if total <= 0 then
+      redis.call('HDEL', KEYS[1], counts[i])
+      if total + n > 0 then
+        redis.call('DECR', KEYS[3])
+        gone = gone + 1
+      end
+    end
+  end
+end
+redis.call('DEL', KEYS[2])
+redis.call('SREM', KEYS[4], ARGV[1])
+return gone
+"""
+
+# leva `node:<id>` (e `users`/`online`, pela diferença) às contagens locais
+_RESTORE_LUA = """
+for i = 2, #ARGV, 2 do
+  local uid, n = ARGV[i], tonumber(ARGV[i + 1])
+  local delta = n - tonumber(redis.call('HGET', KEYS[2], uid) or '0')
+  if delta ~= 0 then
+    local total = redis.call('HINCRBY', KEYS[1], uid, delta)
+    if total <= 0 then redis.call('HDEL', KEYS[1], uid) end
+    if total > 0 and total - delta <= 0 then
+      redis.call('INCR', KEYS[3])
+    elseif total <= 0 and total - delta > 0 then
+      redis.call('DECR', KEYS[3])
+    end
+    if n > 0 then
+      redis.call('HSET', KEYS[2], uid, n)
+    else
+      redis.call('HDEL', KEYS[2], uid)
+    end
+  end
+end
+redis.call('SADD', KEYS[4], ARGV[1])
+return 1
+"""
+
+# 1 se o nó ainda está registrado, 0 se foi descontado (ou é a primeira vez)
+_BEAT_LUA = """
+redis.call('SET', KEYS[1], '1', 'PX', ARGV[2])
+return redis.call('SISMEMBER', KEYS[2], ARGV[1])
+"""
+
+_LEASE_LUA = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+  redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+  return 1
+end
+if current == ARGV[1] then
+  redis.call('PEXPIRE', KEYS[1], ARGV[2])
+  return 1
+end
+return 0
+"""
+
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+class RedisPresenceStore:
+    """Presença global no Redis.
+
+    `users` guarda conexões por usuário e `online` quantos têm alguma; os
+    dois só mudam juntos, dentro de scripts Lua. `node:<id>` espelha as
+    conexões deste nó, para o reaper descontá-las se o nó sumir sem
+    heartbeat. O nó guarda a mesma contagem em memória: se o heartbeat
+    descobre que foi descontado (pausa longa, Redis fora do ar), ele se
+    reinscreve com ela.
+    """
+
+    shared = True  # todos os nós veem o mesmo total: só o líder o anuncia
+
+    def __init__(self, redis, node_id: str = NODE_ID, prefix: str = BROKER_PREFIX,
+                 heartbeat: float = NODE_HEARTBEAT_SECONDS):
+        self.redis = redis
+        self.node_id = node_id
+        self.heartbeat = heartbeat
+        base = f"{prefix}:presence"
+        self._users = f"{base}:users"
+        self._online = f"{base}:online"
+        self._nodes = f"{base}:nodes"
+        self._base = base
+        self._leader = f"{base}:leader"
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = False
+        self._registered = False
+        self._dirty = False  # alguma escrita falhou: reconcilia no próximo heartbeat
+        self._local: dict[str, int] = {}
+        self._add = redis.register_script(_ADD_LUA)
+        self._remove = redis.register_script(_REMOVE_LUA)
+        self._subtract = redis.register_script(_SUBTRACT_LUA)
+        self._restore = redis.register_script(_RESTORE_LUA)
+        self._beat_script = redis.register_script(_BEAT_LUA)
+        self._lease = redis.register_script(_LEASE_LUA)
+        self._release = redis.register_script(_RELEASE_LUA)
+        self.reregistered = 0
+
+    def _node_key(self, node_id: str) -> str:
+        return f"{self._base}:node:{node_id}"
+
+    def _alive_key(self, node_id: str) -> str:
+        return f"{self._base}:alive:{node_id}"
+
+    async def add(self, uid: int) -> bool:
+        if self._stopped:
+            return False
+        uid = str(uid)
+        self._local[uid] = self._local.get(uid, 0) + 1
+        try:
+            total = await self._add(keys=[self._users, self._node_key(self.node_id), self._online], args=[uid])
+        except Exception:
+            self._dirty = True
+            raise
+        return total == 1
+
+    async def remove(self, uid: int) -> bool:
+        if self._stopped:
+            return False
+        uid = str(uid)
+        n = self._local.get(uid, 0) - 1
+        if n > 0:
+            self._local[uid] = n
+        else:
+            self._local.pop(uid, None)
+        try:
+            total = await self._remove(keys=[self._users, self._node_key(self.node_id), self._online], args=[uid])
+        except Exception:
+            self._dirty = True
+            raise
+        return total == 0
+
+    async def online_count(self) -> int:
+        return max(0, int(await self.redis.get(self._online) or 0))
+
+    async def online_among(self, uids: Iterable[int]) -> int:
+        uids = list(uids)
+        if not uids:
+            return 0
+        return sum(1 for n in await self.redis.hmget(self._users, uids) if n and int(n) > 0)
+
+    async def try_lead(self, ttl: float) -> bool:
+        """Disputa (ou renova) o posto de quem anuncia o total online; True se é este nó."""
+        ttl_ms = max(1, int(ttl * 1000))
+        return bool(await self._lease(keys=[self._leader], args=[self.node_id, ttl_ms]))
+
+    async def _subtract_node(self, node_id: str, force: bool = False) -> int:
+        keys = [self._users, self._node_key(node_id), self._online, self._nodes, self._alive_key(node_id)]
+        return await self._subtract(keys=keys, args=[node_id, "1" if force else "0"])
+
+    async def reap_dead_nodes(self):
+        for raw in await self.redis.smembers(self._nodes):
+            node_id = raw.decode() if isinstance(raw, bytes) else raw
+            if node_id == self.node_id:
+                continue
+            # o script confere o heartbeat e desconta de uma vez; repetir não faz nada
+            if await self._subtract_node(node_id) >= 0:
+                log.info("nó %s sem heartbeat: conexões descontadas da presença", node_id)
+
+    async def _reconcile(self):
+        args = [self.node_id]
+        for uid, n in list(self._local.items()):
+            args += [uid, n]
+        await self._restore(keys=[self._users, self._node_key(self.node_id), self._online, self._nodes], args=args)
+        self._dirty = False
+
+    async def _beat(self):
+        ttl_ms = max(1, int(self.heartbeat * 3 * 1000))
+        member = await self._beat_script(keys=[self._alive_key(self.node_id), self._nodes], args=[self.node_id, ttl_ms])
+        if not member or self._dirty:
+            if self._registered and not member:
+                self.reregistered += 1
+                log.warning("nó %s foi dado como morto; reinscrevendo %d usuários", self.node_id, len(self._local))
+            await self._reconcile()
+        self._registered = True
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self._beat()
+                await self.reap_dead_nodes()
+            except Exception:  # Redis fora do ar: tenta de novo no próximo ciclo
+                log.warning("heartbeat do nó %s falhou", self.node_id, exc_info=True)
+
+    async def start(self):
+        await self._beat()
+        await self.reap_dead_nodes()
+        self._task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        # desliga limpo: devolve as conexões deste nó e para de contar
+        self._stopped = True
+        await self._subtract_node(self.node_id, force=True)
+        await self.redis.delete(self._alive_key(self.node_id))
+        await self._release(keys=[self._leader], args=[self.node_id])
+
+class PresenceAggregator:
+    """Agrupa mudanças de presença num único broadcast por intervalo.
+
+    Cada connect/disconnect só marca "sujo"; o primeiro agenda um flush para
+    daqui a `interval` segundos e os seguintes pegam carona nele. No flush o
+    total vai para todos (se mudou) e, com `per_room`, cada sala afetada recebe
+    a contagem dos seus membros online.
+
+    Com presença compartilhada (Redis) o total é o mesmo em todos os nós, então
+    só um deles, eleito por um lease no Redis, o anuncia a cada `interval`; os
+    demais anunciam apenas as salas em que as suas próprias conexões mudaram.
+    """
+
+    def __init__(self, store, emit: Callable[..., Awaitable], interval: float = PRESENCE_BROADCAST_INTERVAL,
+                 per_room: bool = PRESENCE_PER_ROOM,
+                 room_members: Optional[Callable[[int], Awaitable[Iterable[int]]]] = None):
+        self.store = store
+        self.emit = emit
+        self.interval = interval
+        self.per_room = per_room and room_members is not None
+        self.room_members = room_members
+        self._dirty_rooms: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self._leader_task: Optional[asyncio.Task] = None
+        self._last_count: Optional[int] = None
+        self._last_room: dict[int, int] = {}
+        self.changes = 0
+        self.broadcasts = 0
+
+    def mark(self, rooms: Iterable[int] = ()):
+        self.changes += 1
+        if self.per_room:
+            self._dirty_rooms.update(rooms)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        try:
+            await self.flush()
+        except Exception:
+            log.warning("flush da presença falhou", exc_info=True)
+
+    async def _lead(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self.store.try_lead(self.interval * 3):
+                    await self.broadcast_total()
+                else:
+                    self._last_count = None  # se voltar a liderar, anuncia de novo
+            except Exception:
+                log.warning("anúncio da presença global falhou", exc_info=True)
+
+    async def broadcast_total(self):
+        count = await self.store.online_count()
+        if count != self._last_count:
+            self._last_count = count
+            self.broadcasts += 1
+            await self.emit("presence:update", {"active": count})
+
+    async def flush(self):
+        if not self.store.shared:
+            await self.broadcast_total()
+        rooms, self._dirty_rooms = self._dirty_rooms, set()
+        for rid in rooms:
+            online = await self.store.online_among(await self.room_members(rid))
+            if self._last_room.get(rid) != online:
+                self._last_room[rid] = online
+                await self.emit("presence:room", {"roomId": rid, "active": online}, room=f"room:{rid}")
+
+    def start(self):
+        if self.store.shared:
+            self._leader_task = asyncio.create_task(self._lead())
+
+    async def stop(self):
+        for task in (self._task, self._leader_task):
+            if task:
+                task.cancel()
+        self._task = self._leader_task = None
+
+# =========================
+# Backends
+# =========================
+class LocalBackend:
+    name = "local"
+
+    def __init__(self):
+        self.presence = LocalPresenceStore()
+        self._binary = 0
+
+    def client_manager(self):
+        return socketio.AsyncManager()
+
+    def set_binary_sockets(self, n: int):
+        self._binary = n
+
+    def binary_subscribers(self) -> bool:
+        """Há algum socket recebendo msgpack? Sem nenhum, não vale empacotar."""
+        return self._binary > 0
+
+    async def start(self, members_cache=None, revocations=None):
+        await self.presence.start()
+
+    async def stop(self):
+        await self.presence.stop()
+
+class RedisBackend:
+    """Backend via Redis; `client` permite injetar um substituto compatível
+    (ex.: `fakeredis.FakeAsyncRedis`) para presença e invalidação de cache."""
+
+    name = "redis"
+
+    def __init__(self, url: str, client=None, node_id: str = NODE_ID, prefix: str = BROKER_PREFIX):
+        if client is None:
+            import redis.asyncio as aioredis  # dependência opcional
+            client = aioredis.from_url(url)
+        self.url = url
+        self.redis = client
+        self.node_id = node_id
+        self.prefix = prefix
+        self.presence = RedisPresenceStore(client, node_id=node_id, prefix=prefix)
+        self._cache_channel = f"{prefix}:cache"
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._members_cache = None
+        self._revocations = None
+        self._binary = 0
+        self._binary_nodes: dict[str, float] = {}  # outros nós com sockets msgpack -> validade do anúncio
+        self._binary_task: Optional[asyncio.Task] = None
+
+    def client_manager(self):
+        return socketio.AsyncRedisManager(self.url, channel=f"{self.prefix}:socketio")
+
+    # ---- invalidação do cache de membros entre nós ----
+    def _on_cache_change(self, event: str, user_id: Optional[int], room_id: Optional[int]):
+        # chamado pelas funções de escrita do db.py, em qualquer thread
+        if self._loop is None or self._loop.is_closed():
+            return
+        msg = json.dumps({"node": self.node_id, "event": event, "user_id": user_id, "room_id": room_id})
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(self.redis.publish(self._cache_channel, msg))
+        )
+
+    def _revoked_key(self, digest: str) -> str:
+        return f"{self.prefix}:revoked:{digest}"
+
+    async def _publish_revocation(self, digest: str, exp: float):
+        # a chave cobre os nós que ainda vão subir ou reconectar; expira junto com o token
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self._revoked_key(digest), exp, exat=int(exp) + 1)
+        pipe.publish(self._cache_channel, json.dumps(
+            {"node": self.node_id, "event": "token_revoked", "hash": digest, "exp": exp}))
+        await pipe.execute()
+
+    def _on_token_revoked(self, digest: str, exp: float):
+        # chamado pelo logout (threadpool do FastAPI)
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(self._publish_revocation(digest, exp))
+        )
+
+    async def _load_revocations(self):
+        prefix = f"{self.prefix}:revoked:"
+        keys = [k async for k in self.redis.scan_iter(match=prefix + "*", count=500)]
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            for key, exp in zip(chunk, await self.redis.mget(chunk)):
+                if exp is not None:
+                    key = key.decode() if isinstance(key, bytes) else key
+                    self._revocations.add(key[len(prefix):], float(exp), notify=False)
+
+    # ---- sockets msgpack em algum nó ----
+    # Cada nó com sockets msgpack anuncia isso a cada heartbeat (chave com TTL +
+    # evento no canal); os demais só empacotam e publicam a variante binária
+    # enquanto houver algum anúncio válido.
+    def _binary_key(self, node_id: str) -> str:
+        return f"{self.prefix}:binary:{node_id}"
+
+    def _binary_ttl(self) -> float:
+        return self.presence.heartbeat * 3
+
+    def set_binary_sockets(self, n: int):
+        before, self._binary = self._binary, n
+        if (before > 0) != (n > 0) and self._loop is not None:
+            asyncio.ensure_future(self._announce_binary())
+
+    def binary_subscribers(self) -> bool:
+        if self._binary > 0:
+            return True
+        if self._binary_nodes:
+            now = time.monotonic()
+            for node, until in list(self._binary_nodes.items()):
+                if until <= now:
+                    del self._binary_nodes[node]
+        return bool(self._binary_nodes)
+
+    async def _announce_binary(self):
+        on = self._binary > 0
+        pipe = self.redis.pipeline(transaction=False)
+        if on:
+            pipe.set(self._binary_key(self.node_id), 1, px=int(self._binary_ttl() * 1000))
+        else:
+            pipe.delete(self._binary_key(self.node_id))
+        pipe.publish(self._cache_channel, json.dumps({"node": self.node_id, "event": "binary", "on": on}))
+        try:
+            await pipe.execute()
+        except Exception:
+            log.warning("anúncio de sockets msgpack falhou", exc_info=True)
+
+    async def _binary_loop(self):
+        while True:
+            await asyncio.sleep(self.presence.heartbeat)
+            if self._binary > 0:
+                await self._announce_binary()
+
+    async def _load_binary_nodes(self):
+        prefix = f"{self.prefix}:binary:"
+        now = time.monotonic()
+        async for key in self.redis.scan_iter(match=prefix + "*", count=500):
+            key = key.decode() if isinstance(key, bytes) else key
+            node_id = key[len(prefix):]
+            ttl_ms = await self.redis.pttl(key)
+            if node_id != self.node_id and ttl_ms > 0:
+                self._binary_nodes[node_id] = now + ttl_ms / 1000
+
+    def _apply_remote(self, data: dict):
+        if data.get("node") == self.node_id:
+            return
+        if data["event"] == "binary":
+            if data["on"]:
+                self._binary_nodes[data["node"]] = time.monotonic() + self._binary_ttl()
+            else:
+                self._binary_nodes.pop(data["node"], None)
+            return
+        if data["event"] == "token_revoked":
+            if self._revocations is not None:
+                self._revocations.add(data["hash"], data["exp"], notify=False)
+            return
+        cache = self._members_cache
+        if cache is None:
+            return
+        if data["event"] == "room_created":
+            cache.invalidate_rooms()
+            return
+        if data.get("user_id") is not None:
+            cache.invalidate_user(data["user_id"])
+        if data.get("room_id") is not None:
+            cache.invalidate_room(data["room_id"])
+
+    async def _resync(self):
+        # o que foi publicado enquanto o canal estava fora se perdeu: recomeça do banco
+        if self._members_cache is not None:
+            self._members_cache.invalidate_rooms()
+            self._members_cache.clear()
+        if self._revocations is not None:
+            await self._load_revocations()
+        await self._load_binary_nodes()
+
+    async def _listen(self):
+        delay = LISTENER_RETRY_SECONDS
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self._cache_channel)
+                await self._resync()
+                delay = LISTENER_RETRY_SECONDS
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    try:
+                        self._apply_remote(json.loads(item["data"]))
+                    except (ValueError, KeyError):
+                        log.warning("mensagem inválida no canal %s: %r", self._cache_channel, item["data"])
+                log.warning("canal %s encerrado pelo Redis", self._cache_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning("canal %s caiu; reconectando em %.1fs", self._cache_channel, delay, exc_info=True)
+            finally:
+                try:
+                    await pubsub.reset()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTENER_RETRY_MAX_SECONDS)
+
+    async def start(self, members_cache=None, revocations=None):
+        self._loop = asyncio.get_running_loop()
+        await self.presence.start()
+        if members_cache is not None:
+            self._members_cache = members_cache
+            members_cache.subscribe(self._on_cache_change)
+        if revocations is not None:
+            self._revocations = revocations
+            revocations.subscribe(self._on_token_revoked)
+        if members_cache is not None or revocations is not None:
+            self._listener = asyncio.create_task(self._listen())
+        self._binary_task = asyncio.create_task(self._binary_loop())
+
+    async def stop(self):
+        if self._members_cache is not None:
+            self._members_cache.unsubscribe(self._on_cache_change)
+        if self._revocations is not None:
+            self._revocations.unsubscribe(self._on_token_revoked)
+        for task in (self._listener, self._binary_task):
+            if task:
+                task.cancel()
+        self._listener = self._binary_task = None
+        if self._binary > 0:
+            self._binary = 0
+            await self._announce_binary()
+        await self.presence.stop()
+
+def create_backend(url: str = BROKER_URL):
+    if not url:
+        return LocalBackend()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"BROKER_URL não suportado: {url}")
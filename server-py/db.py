@@ -1,24 +1,149 @@
+import os
+import queue
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 
-DB_PATH = Path(__file__).parent / "chat.db"
+from cache import HistoryCache, MembershipCache
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
+DB_PATH = Path(os.getenv("CHAT_DB_PATH", str(Path(__file__).parent / "chat.db")))
+
+# Pool de conexões / PRAGMAs
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # por conexão
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# mensagens arquivadas: um SQLite por mês (messages-AAAA-MM.db), anexado só na leitura
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", str(DB_PATH.parent / "archive")))
+
+def _configure(conn: sqlite3.Connection):
     conn.row_factory = sqlite3.Row
-    return conn
+    # só vale em banco novo (antes do WAL e da 1ª tabela); num banco existente
+    # a troca exige um VACUUM completo: `python archive.py vacuum`
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+class ConnectionPool:
+    """Pool limitado de conexões SQLite de vida longa.
+
+    Cada conexão já sai configurada (WAL, synchronous=NORMAL, mmap, cache) e
+    mantém seu próprio cache de statements preparados (`cached_statements`),
+    então o custo de abrir o arquivo e aquecer o page cache é pago uma vez só.
+    """
+
+    def __init__(self, path, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        # LIFO: a conexão devolvida por último é a com cache mais quente
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        _configure(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("pool de conexões esgotado") from None
+
+    def release(self, conn: sqlite3.Connection):
+        self._idle.put_nowait(conn)
+
+    def discard(self, conn: sqlite3.Connection):
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._created -= 1
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+    def stats(self) -> dict:
+        return {"size": self.size, "open": self._created, "idle": self._idle.qsize()}
+
+_pool = ConnectionPool(DB_PATH)
+
+@contextmanager
+def get_conn():
+    """Empresta uma conexão do pool: commit ao sair, rollback em erro."""
+    conn = _pool.acquire()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            _pool.discard(conn)
+            raise
+        _pool.release(conn)
+        raise
+    else:
+        _pool.release(conn)
+
+def pool_stats() -> dict:
+    return _pool.stats()
+
+def close_pool():
+    _pool.close()
 
 def _column_exists(cur, table, col):
     cur.execute(f"PRAGMA table_info({table})")
     return any(r[1] == col for r in cur.fetchall())
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.executescript("""
-    PRAGMA journal_mode = WAL;
+def _run_script(cur, script: str):
+    """Como executescript, mas sem o COMMIT implícito (roda dentro da migração)."""
+    stmt = ""
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            cur.execute(stmt)
+            stmt = ""
 
+# =========================
+# Migrações (PRAGMA user_version)
+# =========================
+def _migration_1_base_schema(cur):
+    _run_script(cur, """
     CREATE TABLE IF NOT EXISTS users (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
       name TEXT NOT NULL,
@@ -80,13 +205,252 @@ def init_db():
             ("Geral", datetime.utcnow().isoformat())
         )
 
-    conn.commit()
-    conn.close()
+def _migration_2_message_indexes(cur):
+    # histórico de sala: WHERE type='room' AND room_id=? ORDER BY id
+    # DM: chave normalizada da conversa (menor id, maior id), sem OR
+    _run_script(cur, """
+    CREATE INDEX IF NOT EXISTS idx_messages_room
+      ON messages (room_id, id) WHERE type = 'room';
 
-def get_room_by_name(name: str):
+    CREATE INDEX IF NOT EXISTS idx_messages_dm_pair
+      ON messages (min(sender_id, recipient_id), max(sender_id, recipient_id), id) WHERE type = 'dm';
+    """)
+
+def _migration_3_room_members_by_room(cur):
+    # membros de uma sala (a PK é (user_id, room_id) e só serve ao outro sentido)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_room_members_room ON room_members (room_id, user_id)")
+
+def _migration_4_attachments(cur):
+    # anexos por conteúdo (sha256); refcount acompanha messages.attachment_url
+    _run_script(cur, """
+    CREATE TABLE IF NOT EXISTS attachments (
+      sha256 TEXT PRIMARY KEY,
+      url TEXT NOT NULL UNIQUE,
+      mime TEXT NOT NULL,
+      size INTEGER NOT NULL,
+      refcount INTEGER NOT NULL DEFAULT 0,
+      created_at TEXT NOT NULL,
+      last_seen_at TEXT NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_attachments_orphans
+      ON attachments (last_seen_at) WHERE refcount <= 0;
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_attachment_ref
+    AFTER INSERT ON messages WHEN NEW.attachment_url IS NOT NULL
+    BEGIN
+      UPDATE attachments SET refcount = refcount + 1 WHERE url = NEW.attachment_url;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_attachment_unref
+    AFTER DELETE ON messages WHEN OLD.attachment_url IS NOT NULL
+    BEGIN
+      UPDATE attachments SET refcount = refcount - 1 WHERE url = OLD.attachment_url;
+    END;
+    """)
+    cur.execute("""
+        UPDATE attachments
+        SET refcount = (SELECT COUNT(*) FROM messages m WHERE m.attachment_url = attachments.url)
+    """)
+
+def _migration_5_attachment_variants(cur):
+    # miniatura/WebP: no anexo (gerados depois do upload) e copiados na mensagem
+    for table, col in (
+        ("attachments", "thumb_url"), ("attachments", "webp_url"),
+        ("messages", "attachment_thumb_url"), ("messages", "attachment_webp_url"),
+    ):
+        if not _column_exists(cur, table, col):
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} TEXT")
+    if not _column_exists(cur, "attachments", "variants_done"):
+        cur.execute("ALTER TABLE attachments ADD COLUMN variants_done INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_attachment
+          ON messages (attachment_url) WHERE attachment_url IS NOT NULL
+    """)
+
+def _migration_6_messages_fts(cur):
+    # índice full-text sobre messages.content (external content: o texto não é
+    # duplicado) mantido pelos triggers e preenchido com 'rebuild'
+    _run_script(cur, """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+      content, content='messages', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+    BEGIN
+      INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages
+    BEGIN
+      INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF content ON messages
+    BEGIN
+      INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+      INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+
+    INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+    """)
+
+def _migration_7_unread(cur):
+    # contadores por conversa mantidos no INSERT (nada de COUNT(*) em messages):
+    # não lidas = conv_stats.msg_count - read_markers.read_count
+    _run_script(cur, """
+    CREATE TABLE IF NOT EXISTS conv_stats (
+      conv_key TEXT PRIMARY KEY,          -- 'room:<id>' ou 'dm:<menor id>:<maior id>'
+      room_id INTEGER,
+      user_a INTEGER,
+      user_b INTEGER,
+      msg_count INTEGER NOT NULL DEFAULT 0,
+      last_id INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_conv_stats_room ON conv_stats (room_id) WHERE room_id IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_conv_stats_user_a ON conv_stats (user_a) WHERE user_a IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_conv_stats_user_b ON conv_stats (user_b) WHERE user_b IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS read_markers (
+      user_id INTEGER NOT NULL,
+      conv_key TEXT NOT NULL,
+      last_read_id INTEGER NOT NULL DEFAULT 0,
+      read_count INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (user_id, conv_key)
+    ) WITHOUT ROWID;
+
+    -- cada mensagem soma 1 na conversa e conta como lida para quem enviou
+    CREATE TRIGGER IF NOT EXISTS trg_messages_unread_room AFTER INSERT ON messages
+    WHEN new.type = 'room'
+    BEGIN
+      INSERT INTO conv_stats (conv_key, room_id, msg_count, last_id)
+      VALUES ('room:' || new.room_id, new.room_id, 1, new.id)
+      ON CONFLICT (conv_key) DO UPDATE SET msg_count = msg_count + 1, last_id = excluded.last_id;
+      INSERT INTO read_markers (user_id, conv_key, last_read_id, read_count)
+      SELECT new.sender_id, conv_key, last_id, msg_count FROM conv_stats WHERE conv_key = 'room:' || new.room_id
+      ON CONFLICT (user_id, conv_key) DO UPDATE SET last_read_id = excluded.last_read_id,
+                                                    read_count = excluded.read_count;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_unread_dm AFTER INSERT ON messages
+    WHEN new.type = 'dm'
+    BEGIN
+      INSERT INTO conv_stats (conv_key, user_a, user_b, msg_count, last_id)
+      VALUES ('dm:' || min(new.sender_id, new.recipient_id) || ':' || max(new.sender_id, new.recipient_id),
+              min(new.sender_id, new.recipient_id), max(new.sender_id, new.recipient_id), 1, new.id)
+      ON CONFLICT (conv_key) DO UPDATE SET msg_count = msg_count + 1, last_id = excluded.last_id;
+      INSERT INTO read_markers (user_id, conv_key, last_read_id, read_count)
+      SELECT new.sender_id, conv_key, last_id, msg_count FROM conv_stats
+      WHERE conv_key = 'dm:' || min(new.sender_id, new.recipient_id) || ':' || max(new.sender_id, new.recipient_id)
+      ON CONFLICT (user_id, conv_key) DO UPDATE SET last_read_id = excluded.last_read_id,
+                                                    read_count = excluded.read_count;
+    END;
+
+    -- histórico que já existia: conta uma vez e considera tudo lido
+    INSERT OR REPLACE INTO conv_stats (conv_key, room_id, msg_count, last_id)
+    SELECT 'room:' || room_id, room_id, count(*), max(id) FROM messages WHERE type = 'room' GROUP BY room_id;
+
+    INSERT OR REPLACE INTO conv_stats (conv_key, user_a, user_b, msg_count, last_id)
+    SELECT 'dm:' || min(sender_id, recipient_id) || ':' || max(sender_id, recipient_id),
+           min(sender_id, recipient_id), max(sender_id, recipient_id), count(*), max(id)
+    FROM messages WHERE type = 'dm'
+    GROUP BY min(sender_id, recipient_id), max(sender_id, recipient_id);
+
+    INSERT OR REPLACE INTO read_markers (user_id, conv_key, last_read_id, read_count)
+    SELECT rm.user_id, s.conv_key, s.last_id, s.msg_count
+    FROM room_members rm JOIN conv_stats s ON s.room_id = rm.room_id;
+
+    INSERT OR REPLACE INTO read_markers (user_id, conv_key, last_read_id, read_count)
+    SELECT user_a, conv_key, last_id, msg_count FROM conv_stats WHERE user_a IS NOT NULL
+    UNION ALL
+    SELECT user_b, conv_key, last_id, msg_count FROM conv_stats WHERE user_b IS NOT NULL;
+    """)
+
+def _migration_8_archive_catalog(cur):
+    # quais meses do arquivo têm mensagens de cada conversa (e a faixa de ids),
+    # para a paginação descer só nos arquivos que interessam
+    _run_script(cur, """
+    CREATE TABLE IF NOT EXISTS archive_convs (
+      conv_key TEXT NOT NULL,
+      month TEXT NOT NULL,                -- 'AAAA-MM' (arquivo messages-AAAA-MM.db)
+      min_id INTEGER NOT NULL,
+      max_id INTEGER NOT NULL,
+      msg_count INTEGER NOT NULL,
+      PRIMARY KEY (conv_key, month)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_archive_convs_month ON archive_convs (month);
+    """)
+
+# A versão do schema é a posição na lista (1-based); só acrescente no final.
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_message_indexes,
+    _migration_3_room_members_by_room,
+    _migration_4_attachments,
+    _migration_5_attachment_variants,
+    _migration_6_messages_fts,
+    _migration_7_unread,
+    _migration_8_archive_catalog,
+]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Aplica, cada uma em sua transação, as migrações ainda não aplicadas."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # outro processo pode ter migrado enquanto esperávamos o lock
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                conn.rollback()
+                continue
+            step(cur)
+            cur.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        version = target
+    conn.execute("PRAGMA optimize")
+    return version
+
+def init_db():
+    with get_conn() as conn:
+        migrate(conn)
+
+# =========================
+# Cache de salas / membros
+# =========================
+def _load_user_rooms(user_id: int):
     with get_conn() as c:
-        row = c.execute("SELECT id, name FROM rooms WHERE name = ?", (name,)).fetchone()
-        return dict(row) if row else None
+        return [r[0] for r in c.execute("SELECT room_id FROM room_members WHERE user_id = ?", (user_id,))]
+
+def _load_room_members(room_id: int):
+    with get_conn() as c:
+        return [r[0] for r in c.execute("SELECT user_id FROM room_members WHERE room_id = ?", (room_id,))]
+
+def _load_rooms():
+    with get_conn() as c:
+        return [(r[0], r[1]) for r in c.execute("SELECT id, name FROM rooms")]
+
+members_cache = MembershipCache(
+    _load_user_rooms, _load_room_members, _load_rooms,
+    max_users=int(os.getenv("MEMBERSHIP_CACHE_MAX_USERS", "100000")),
+    max_rooms=int(os.getenv("MEMBERSHIP_CACHE_MAX_ROOMS", "10000")),
+)
+
+# Histórico recente em memória. Com broker (vários nós) cada nó só veria os
+# próprios INSERTs, então o padrão é desligado nesse caso.
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "0" if os.getenv("BROKER_URL", "").strip() else "1") == "1"
+history_cache = HistoryCache(
+    per_conv=int(os.getenv("HISTORY_CACHE_PER_CONV", "256")),
+    max_bytes=int(os.getenv("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024))),
+) if HISTORY_CACHE_ENABLED else None
+
+def get_room_by_name(name: str):
+    rid = members_cache.room_id_by_name(name)
+    return {"id": rid, "name": name} if rid is not None else None
 
 def find_user_by_email(email: str):
     with get_conn() as c:
@@ -106,16 +470,15 @@ def insert_user(name, email, password_hash):
         )
         return cur.lastrowid
 
-def list_my_rooms(my_id: int):
+def update_password_hash(uid: int, password_hash: str):
     with get_conn() as c:
-        rows = c.execute("""
-            SELECT r.id, r.name
-            FROM rooms r
-            JOIN room_members m ON m.room_id = r.id
-            WHERE m.user_id = ?
-            ORDER BY r.name
-        """, (my_id,)).fetchall()
-        return [dict(r) for r in rows]
+        c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, uid))
+
+def list_my_rooms(my_id: int):
+    names = members_cache.room_names()
+    rows = [{"id": rid, "name": names[rid]} for rid in members_cache.user_rooms(my_id) if rid in names]
+    rows.sort(key=lambda r: r["name"])
+    return rows
 
 def create_room(name: str):
     with get_conn() as c:
@@ -123,71 +486,473 @@ def create_room(name: str):
             "INSERT INTO rooms (name, created_at) VALUES (?, ?)",
             (name, datetime.utcnow().isoformat())
         )
-        return cur.lastrowid
+        rid = cur.lastrowid
+    members_cache.on_room_created(rid, name)
+    return rid
 
 def join_room(user_id: int, room_id: int):
     with get_conn() as c:
-        c.execute(
+        cur = c.execute(
             "INSERT OR IGNORE INTO room_members (user_id, room_id) VALUES (?, ?)",
             (user_id, room_id)
         )
+        if cur.rowcount:  # quem acabou de entrar não herda o histórico como "não lido"
+            _mark_read(c, user_id, room_conv_key(room_id))
+    members_cache.on_join(user_id, room_id)
 
 def leave_room(user_id: int, room_id: int):
     with get_conn() as c:
         c.execute("DELETE FROM room_members WHERE user_id = ? AND room_id = ?", (user_id, room_id))
+    members_cache.on_leave(user_id, room_id)
 
 def room_exists(room_id: int) -> bool:
-    with get_conn() as c:
-        row = c.execute("SELECT id FROM rooms WHERE id = ?", (room_id,)).fetchone()
-        return bool(row)
+    return members_cache.room_name(room_id) is not None
 
 def is_member(user_id: int, room_id: int) -> bool:
-    with get_conn() as c:
-        row = c.execute(
-            "SELECT 1 FROM room_members WHERE user_id = ? AND room_id = ?",
-            (user_id, room_id)
-        ).fetchone()
-        return bool(row)
+    return members_cache.is_member(user_id, room_id)
+
+def room_member_ids(room_id: int) -> frozenset:
+    return members_cache.room_members(room_id)
+
+def membership_stats() -> dict:
+    return members_cache.stats()
+
+# Linha completa (mesmo formato do histórico) devolvida pelo próprio INSERT
+_RETURNING_MESSAGE = """
+    RETURNING *, (SELECT u.name FROM users u WHERE u.id = messages.sender_id) AS sender_name
+"""
+
+# variantes já prontas do anexo entram junto com a mensagem
+_ATTACHMENT_VARIANTS = """
+    (SELECT a.thumb_url FROM attachments a WHERE a.url = ?1),
+    (SELECT a.webp_url FROM attachments a WHERE a.url = ?1)
+"""
+
+_INSERT_MESSAGE = """
+    INSERT INTO messages (type, attachment_url, room_id, recipient_id, sender_id, content, created_at,
+                          attachment_type, attachment_thumb_url, attachment_webp_url)
+    VALUES (?7, ?1, ?2, ?3, ?4, ?5, ?6, ?8, """ + _ATTACHMENT_VARIANTS + ")" + _RETURNING_MESSAGE
+
+def _insert_message(c, kind: str, sender_id: int, content: str, room_id=None, recipient_id=None,
+                    attachment_url=None, attachment_type=None) -> dict:
+    row = c.execute(_INSERT_MESSAGE, (
+        attachment_url, room_id, recipient_id, sender_id, content,
+        datetime.utcnow().isoformat(), kind, attachment_type,
+    )).fetchone()
+    return dict(row)
+
+def _conv_key(msg: dict) -> str:
+    if msg["type"] == "room":
+        return room_conv_key(msg["room_id"])
+    return dm_conv_key(msg["sender_id"], msg["recipient_id"])
+
+def _cache_inserted(msgs):
+    # só depois do commit: o cache nunca mostra o que pode sofrer rollback
+    if history_cache is not None:
+        for msg in msgs:
+            history_cache.add(_conv_key(msg), msg)
 
 def insert_room_message(room_id: int, sender_id: int, content: str, attachment_url=None, attachment_type=None):
     with get_conn() as c:
-        cur = c.execute("""
-            INSERT INTO messages (type, room_id, sender_id, content, created_at, attachment_url, attachment_type)
-            VALUES ('room', ?, ?, ?, ?, ?, ?)
-        """, (room_id, sender_id, content, datetime.utcnow().isoformat(), attachment_url, attachment_type))
-        return cur.lastrowid
+        msg = _insert_message(c, "room", sender_id, content, room_id=room_id,
+                              attachment_url=attachment_url, attachment_type=attachment_type)
+    _cache_inserted([msg])
+    return msg
 
 def insert_dm(sender_id: int, recipient_id: int, content: str, attachment_url=None, attachment_type=None):
     with get_conn() as c:
-        cur = c.execute("""
-            INSERT INTO messages (type, sender_id, recipient_id, content, created_at, attachment_url, attachment_type)
-            VALUES ('dm', ?, ?, ?, ?, ?, ?)
-        """, (sender_id, recipient_id, content, datetime.utcnow().isoformat(), attachment_url, attachment_type))
-        return cur.lastrowid
+        msg = _insert_message(c, "dm", sender_id, content, recipient_id=recipient_id,
+                              attachment_url=attachment_url, attachment_type=attachment_type)
+    _cache_inserted([msg])
+    return msg
+
+def insert_messages_batch(items: list) -> list:
+    """Insere várias mensagens numa transação só (um commit/fsync para todas).
+
+    Cada item tem os argumentos nomeados de `_insert_message` (kind, sender_id,
+    content, room_id/recipient_id, attachment_*). Devolve, na mesma ordem, a
+    linha inserida ou a exceção daquele item: cada INSERT roda num SAVEPOINT,
+    então uma mensagem inválida não derruba as outras do lote.
+    """
+    out = []
+    with get_conn() as c:
+        c.execute("BEGIN IMMEDIATE")
+        for item in items:
+            c.execute("SAVEPOINT msg")
+            try:
+                out.append(_insert_message(c, **item))
+            except sqlite3.Error as e:
+                c.execute("ROLLBACK TO msg")
+                out.append(e)
+            c.execute("RELEASE msg")
+    _cache_inserted(m for m in out if isinstance(m, dict))
+    return out
+
+HISTORY_PAGE_SIZE = 50
+
+def _page(c, table: str, where: str, params: tuple, before_id, after_id, limit: int, forward: bool):
+    """Uma página de `table` (messages ou archive.messages), na ordem do keyset."""
+    sql = f"""
+        SELECT m.*, u.name AS sender_name
+        FROM {table} m
+        JOIN main.users u ON u.id = m.sender_id
+        WHERE {where}
+    """
+    args = list(params)
+    if before_id is not None:
+        sql += " AND m.id < ?"
+        args.append(before_id)
+    if after_id is not None:
+        sql += " AND m.id > ?"
+        args.append(after_id)
+    sql += f" ORDER BY m.id {'ASC' if forward else 'DESC'} LIMIT ?"
+    args.append(limit)
+    return [dict(r) for r in c.execute(sql, args).fetchall()]
 
-def room_history(room_id: int):
+def _history(where: str, params: tuple, before_id=None, after_id=None, limit=HISTORY_PAGE_SIZE, conv_key=None):
+    """Página de mensagens (keyset pelo id), sempre em ordem cronológica.
+
+    Sem cursor devolve as `limit` mais recentes; com `before_id`, as anteriores
+    a ele (rolar para cima); com `after_id`, as seguintes (alcançar o presente).
+    Com `conv_key`, a página continua nos meses arquivados quando o banco
+    quente não tem mensagens suficientes.
+    """
+    forward = after_id is not None and before_id is None
+    with get_conn() as c:
+        if forward:
+            # do mais antigo para o mais novo: arquivo (se o cursor for antigo), depois o quente
+            rows, cursor = [], after_id
+            for month in _archive_months(c, conv_key, None, after_id, forward):
+                rows += _archive_page(c, month, where, params, None, cursor, limit - len(rows), forward)
+                if len(rows) >= limit:
+                    return rows
+                cursor = rows[-1]["id"] if rows else cursor
+            return rows + _page(c, "main.messages", where, params, None, cursor, limit - len(rows), forward)
+        rows = _page(c, "main.messages", where, params, before_id, after_id, limit, forward)
+        if len(rows) < limit:
+            cursor = rows[-1]["id"] if rows else before_id
+            for month in _archive_months(c, conv_key, cursor, after_id, forward):
+                rows += _archive_page(c, month, where, params, cursor, after_id, limit - len(rows), forward)
+                if len(rows) >= limit:
+                    break
+                cursor = rows[-1]["id"] if rows else cursor
+    rows.reverse()
+    return rows
+
+def _cached_history(key: str, fetch, before_id, after_id, limit):
+    """Página do `history_cache`; na falta, carrega o buffer da conversa (uma
+    vez) e, se a página for mais antiga que ele, lê direto do SQLite."""
+    if history_cache is None:
+        return fetch(before_id, after_id, limit)
+    rows = history_cache.get(key, before_id, after_id, limit)
+    if rows is not None:
+        return rows
+    if history_cache.begin_load(key):
+        try:
+            latest = fetch(None, None, history_cache.per_conv)
+        except BaseException:
+            history_cache.abort_load(key)
+            raise
+        history_cache.install(key, latest)
+        rows = history_cache.get(key, before_id, after_id, limit)
+        if rows is not None:
+            return rows
+    return fetch(before_id, after_id, limit)
+
+def room_history(room_id: int, before_id=None, after_id=None, limit=HISTORY_PAGE_SIZE):
+    return _cached_history(
+        room_conv_key(room_id),
+        lambda before, after, n: _history("m.type = 'room' AND m.room_id = ?", (room_id,), before, after, n,
+                                          room_conv_key(room_id)),
+        before_id, after_id, limit,
+    )
+
+def dm_history(a: int, b: int, before_id=None, after_id=None, limit=HISTORY_PAGE_SIZE):
+    # mesmas expressões do idx_messages_dm_pair, para o planner usar o índice
+    return _cached_history(
+        dm_conv_key(a, b),
+        lambda before, after, n: _history(
+            "m.type = 'dm' AND min(m.sender_id, m.recipient_id) = ? AND max(m.sender_id, m.recipient_id) = ?",
+            (min(a, b), max(a, b)), before, after, n, dm_conv_key(a, b)
+        ),
+        before_id, after_id, limit,
+    )
+
+def history_cache_stats() -> dict:
+    return history_cache.stats() if history_cache is not None else {"enabled": False}
+
+# ---------- Não lidas ----------
+def room_conv_key(room_id: int) -> str:
+    return f"room:{room_id}"
+
+def dm_conv_key(a: int, b: int) -> str:
+    return f"dm:{min(a, b)}:{max(a, b)}"
+
+def _mark_read(c, user_id: int, conv_key: str):
+    c.execute("""
+        INSERT INTO read_markers (user_id, conv_key, last_read_id, read_count)
+        SELECT ?, ?, coalesce(max(last_id), 0), coalesce(max(msg_count), 0) FROM conv_stats WHERE conv_key = ?
+        ON CONFLICT (user_id, conv_key) DO UPDATE SET last_read_id = excluded.last_read_id,
+                                                      read_count = excluded.read_count
+    """, (user_id, conv_key, conv_key))
+
+def mark_read(user_id: int, conv_key: str):
+    """Marca a conversa inteira como lida para o usuário."""
+    with get_conn() as c:
+        _mark_read(c, user_id, conv_key)
+
+def unread_summary(user_id: int):
+    """Não lidas por sala (das que o usuário participa) e por DM, só as que têm mensagens."""
     with get_conn() as c:
         rows = c.execute("""
-            SELECT m.*, u.name AS sender_name
-            FROM messages m
-            JOIN users u ON u.id = m.sender_id
-            WHERE m.type = 'room' AND m.room_id = ?
-            ORDER BY m.id ASC
-            LIMIT 300
-        """, (room_id,)).fetchall()
-        return [dict(r) for r in rows]
+            SELECT s.room_id, CASE s.user_a WHEN ?1 THEN s.user_b ELSE s.user_a END AS other_id,
+                   max(0, s.msg_count - coalesce(r.read_count, 0)) AS unread,
+                   s.last_id, coalesce(r.last_read_id, 0) AS last_read_id
+            FROM (
+              SELECT * FROM conv_stats WHERE room_id IN (SELECT room_id FROM room_members WHERE user_id = ?1)
+              UNION ALL SELECT * FROM conv_stats WHERE user_a = ?1
+              UNION ALL SELECT * FROM conv_stats WHERE user_b = ?1 AND user_a <> ?1
+            ) s
+            LEFT JOIN read_markers r ON r.user_id = ?1 AND r.conv_key = s.conv_key
+        """, (user_id,)).fetchall()
+    out = {"rooms": [], "dms": []}
+    for r in rows:
+        item = {"unread": r["unread"], "last_id": r["last_id"], "last_read_id": r["last_read_id"]}
+        if r["room_id"] is not None:
+            out["rooms"].append({"id": r["room_id"], **item})
+        else:
+            out["dms"].append({"id": r["other_id"], **item})
+    return out
+
+def missed_messages(user_id: int, after_id: int, limit=HISTORY_PAGE_SIZE):
+    """As primeiras `limit` mensagens com id > `after_id` em todas as salas e
+    DMs do usuário, em ordem cronológica (catch-up após reconexão).
+
+    `conv_stats.last_id` diz quais conversas receberam algo depois de
+    `after_id`; só essas são lidas, cada uma pelo seu índice.
+    """
+    with get_conn() as c:
+        convs = c.execute("""
+            SELECT room_id, user_a, user_b FROM conv_stats
+            WHERE last_id > ?2
+              AND (room_id IN (SELECT room_id FROM room_members WHERE user_id = ?1)
+                   OR user_a = ?1 OR user_b = ?1)
+        """, (user_id, after_id)).fetchall()
+    rows = []
+    for conv in convs:
+        if conv["room_id"] is not None:
+            rows += room_history(conv["room_id"], after_id=after_id, limit=limit)
+        else:
+            rows += dm_history(conv["user_a"], conv["user_b"], after_id=after_id, limit=limit)
+    rows.sort(key=lambda m: m["id"])
+    return rows[:limit]
 
-def dm_history(a: int, b: int):
+# ---------- Arquivo (retenção) ----------
+# conversa de uma linha de messages (mesma chave de conv_stats)
+_CONV_KEY_SQL = """
+    CASE type WHEN 'room' THEN 'room:' || room_id
+    ELSE 'dm:' || min(sender_id, recipient_id) || ':' || max(sender_id, recipient_id) END
+"""
+
+def archive_path(month: str) -> Path:
+    return ARCHIVE_DIR / f"messages-{month}.db"
+
+@contextmanager
+def _attached(c, month: str):
+    """Anexa o arquivo do mês como `archive` enquanto durar o bloco."""
+    try:
+        c.execute("ATTACH DATABASE ? AS archive", (str(archive_path(month)),))
+    except sqlite3.OperationalError:  # sobrou de um erro anterior nesta conexão
+        c.execute("DETACH DATABASE archive")
+        c.execute("ATTACH DATABASE ? AS archive", (str(archive_path(month)),))
+    try:
+        yield
+    finally:
+        if c.in_transaction:  # erro no meio da cópia: o DETACH exige a transação fechada
+            c.rollback()
+        c.execute("DETACH DATABASE archive")
+
+def _archive_months(c, conv_key, before_id, after_id, forward: bool) -> list:
+    """Meses arquivados da conversa que podem ter ids na faixa, na ordem da leitura."""
+    if conv_key is None:
+        return []
+    rows = c.execute(f"""
+        SELECT month FROM archive_convs
+        WHERE conv_key = ? AND min_id < coalesce(?, 1 << 62) AND max_id > coalesce(?, -1)
+        ORDER BY max_id {'ASC' if forward else 'DESC'}
+    """, (conv_key, before_id, after_id)).fetchall()
+    return [r[0] for r in rows]
+
+def _archive_page(c, month: str, where, params, before_id, after_id, limit: int, forward: bool) -> list:
+    if limit <= 0 or not archive_path(month).exists():  # mês já descartado pela retenção
+        return []
+    with _attached(c, month):
+        return _page(c, "archive.messages", where, params, before_id, after_id, limit, forward)
+
+def _ensure_archive_schema(c):
+    """Cria/atualiza archive.messages com as colunas atuais de messages."""
+    cols = [(r[1], r[2]) for r in c.execute("PRAGMA main.table_info(messages)") if r[1] != "id"]
+    c.execute("CREATE TABLE IF NOT EXISTS archive.messages (id INTEGER PRIMARY KEY, "
+              + ", ".join(f"{name} {decl}" for name, decl in cols) + ")")
+    have = {r[1] for r in c.execute("PRAGMA archive.table_info(messages)")}
+    for name, decl in cols:
+        if name not in have:
+            c.execute(f"ALTER TABLE archive.messages ADD COLUMN {name} {decl}")
+    c.execute("CREATE INDEX IF NOT EXISTS archive.idx_messages_room ON messages (room_id, id) WHERE type = 'room'")
+    c.execute("""CREATE INDEX IF NOT EXISTS archive.idx_messages_dm_pair
+                 ON messages (min(sender_id, recipient_id), max(sender_id, recipient_id), id) WHERE type = 'dm'""")
+    return ["id"] + [name for name, _ in cols]
+
+def archive_messages_batch(cutoff: str, batch: int = 2000) -> int:
+    """Move para o arquivo as mensagens mais antigas (created_at < `cutoff`), até `batch`.
+
+    As mais antigas estão sempre no começo da tabela (ids crescem com o tempo),
+    então basta ler pela PK, sem índice em created_at. Cada mês é copiado e
+    conferido no seu arquivo antes de a linha sair do banco quente; se o
+    processo cair no meio, a próxima rodada repete a cópia (INSERT OR IGNORE)
+    e termina a remoção. Devolve quantas mensagens saíram (0 = nada a fazer).
+    """
+    with get_conn() as c:
+        head = c.execute("SELECT id, created_at FROM messages ORDER BY id LIMIT ?", (batch,)).fetchall()
+        old = []
+        for r in head:
+            if r["created_at"] >= cutoff:
+                break
+            old.append(r)
+        if not old:
+            return 0
+        lo, hi = old[0]["id"], old[-1]["id"]
+        months = sorted({r["created_at"][:7] for r in old})
+        ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+        moved = 0
+        for month in months:
+            scope = "id BETWEEN ? AND ? AND substr(created_at, 1, 7) = ? AND created_at < ?"
+            args = (lo, hi, month, cutoff)
+            with _attached(c, month):
+                cols = ", ".join(_ensure_archive_schema(c))
+                c.execute(f"INSERT OR IGNORE INTO archive.messages ({cols}) SELECT {cols} FROM main.messages WHERE {scope}", args)
+                copied = c.execute(f"SELECT count(*) FROM archive.messages WHERE {scope}", args).fetchone()[0]
+                expected = c.execute(f"SELECT count(*) FROM main.messages WHERE {scope}", args).fetchone()[0]
+                if copied != expected:
+                    raise sqlite3.DatabaseError(f"arquivo {month}: {copied} de {expected} mensagens copiadas")
+                c.commit()
+            # catálogo, refcount e remoção juntos; os triggers de DELETE já
+            # tiram a mensagem do FTS e descontam o anexo, que continua em uso
+            # no arquivo e por isso é recontado aqui. conv_stats/read_markers
+            # não mudam: as não lidas continuam batendo.
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(f"""
+                INSERT INTO archive_convs (conv_key, month, min_id, max_id, msg_count)
+                SELECT {_CONV_KEY_SQL}, ?, min(id), max(id), count(*)
+                FROM messages WHERE {scope} GROUP BY 1
+                ON CONFLICT (conv_key, month) DO UPDATE SET
+                  min_id = min(min_id, excluded.min_id), max_id = max(max_id, excluded.max_id),
+                  msg_count = msg_count + excluded.msg_count
+            """, (month, *args))
+            refs = c.execute(f"""
+                SELECT attachment_url, count(*) FROM messages
+                WHERE {scope} AND attachment_url IS NOT NULL GROUP BY 1
+            """, args).fetchall()
+            moved += c.execute(f"DELETE FROM messages WHERE {scope}", args).rowcount
+            c.executemany("UPDATE attachments SET refcount = refcount + ? WHERE url = ?",
+                          [(n, url) for url, n in refs])
+            c.commit()
+    # o cache de histórico continua válido: as mensagens só mudaram de arquivo
+    return moved
+
+def archive_months() -> list:
+    with get_conn() as c:
+        return [r[0] for r in c.execute("SELECT DISTINCT month FROM archive_convs ORDER BY month")]
+
+def drop_archive_month(month: str) -> int:
+    """Descarta de vez um mês arquivado; devolve quantas mensagens ele tinha.
+
+    Os anexos perdem as referências do mês (a coleta de lixo cuida do resto)
+    e as conversas afetadas saem do cache de histórico.
+    """
+    path = archive_path(month)
+    with get_conn() as c:
+        refs = []
+        if path.exists():
+            with _attached(c, month):
+                refs = c.execute("""
+                    SELECT attachment_url, count(*) FROM archive.messages
+                    WHERE attachment_url IS NOT NULL GROUP BY 1
+                """).fetchall()
+        c.execute("BEGIN IMMEDIATE")
+        convs = c.execute("DELETE FROM archive_convs WHERE month = ? RETURNING conv_key, msg_count",
+                          (month,)).fetchall()
+        c.executemany("UPDATE attachments SET refcount = refcount - ? WHERE url = ?",
+                      [(n, url) for url, n in refs])
+        c.commit()
+    # depois do commit: sem linha no catálogo o arquivo já não é lido
+    path.unlink(missing_ok=True)
+    if history_cache is not None:
+        for key, _ in convs:
+            history_cache.invalidate(key)
+    return sum(n for _, n in convs)
+
+def maintenance(vacuum_pages: int = 1000, checkpoint: str = "PASSIVE") -> dict:
+    """VACUUM incremental (devolve ao disco até `vacuum_pages` páginas livres),
+    checkpoint do WAL e PRAGMA optimize."""
+    with get_conn() as c:
+        auto_vacuum = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+        free = c.execute("PRAGMA freelist_count").fetchone()[0]
+        if auto_vacuum == 2 and free and vacuum_pages > 0:  # 2 = INCREMENTAL
+            c.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})").fetchall()
+        busy, wal_pages, checkpointed = c.execute(f"PRAGMA wal_checkpoint({checkpoint})").fetchone()
+        c.execute("PRAGMA optimize")
+        return {
+            "auto_vacuum": auto_vacuum,
+            "freed_pages": free - c.execute("PRAGMA freelist_count").fetchone()[0],
+            "page_count": c.execute("PRAGMA page_count").fetchone()[0],
+            "wal_busy": bool(busy),
+            "wal_pages": wal_pages,
+            "wal_checkpointed": checkpointed,
+        }
+
+def vacuum_full():
+    """VACUUM completo, já ligando o auto_vacuum incremental (trava o banco enquanto roda)."""
+    with get_conn() as c:
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+
+# ---------- Busca ----------
+SEARCH_MAX_TERMS = 8
+
+def fts_query(text: str) -> str:
+    """Converte o texto digitado numa consulta FTS5 segura.
+
+    Cada palavra vira uma frase entre aspas (operadores, aspas e `*` do usuário
+    não chegam ao parser) e a última casa por prefixo, para buscar enquanto se
+    digita. Devolve "" se não sobrar nenhuma palavra.
+    """
+    terms = re.findall(r"\w+", text or "")[:SEARCH_MAX_TERMS]
+    if not terms:
+        return ""
+    return " ".join(f'"{t}"' for t in terms) + "*"
+
+def search_messages(user_id: int, text: str, limit=HISTORY_PAGE_SIZE, offset=0):
+    """Mensagens que casam com `text` nas salas do usuário e nas DMs dele,
+    das mais relevantes (bm25) para as menos. Só o banco quente é indexado:
+    mensagens arquivadas não aparecem na busca."""
+    query = fts_query(text)
+    if not query:
+        return []
     with get_conn() as c:
         rows = c.execute("""
             SELECT m.*, u.name AS sender_name
-            FROM messages m
+            FROM messages_fts f
+            JOIN messages m ON m.id = f.rowid
             JOIN users u ON u.id = m.sender_id
-            WHERE m.type = 'dm'
-              AND ((m.sender_id = ? AND m.recipient_id = ?) OR (m.sender_id = ? AND m.recipient_id = ?))
-            ORDER BY m.id ASC
-            LIMIT 300
-        """, (a, b, b, a)).fetchall()
+            WHERE messages_fts MATCH ?
+              AND (
+                (m.type = 'room' AND m.room_id IN (SELECT room_id FROM room_members WHERE user_id = ?))
+                OR (m.type = 'dm' AND (m.sender_id = ? OR m.recipient_id = ?))
+              )
+            ORDER BY bm25(messages_fts), m.id DESC
+            LIMIT ? OFFSET ?
+        """, (query, user_id, user_id, user_id, limit, offset)).fetchall()
         return [dict(r) for r in rows]
 
 # ---------- DMs salvas ----------
@@ -212,3 +977,89 @@ def list_dm_contacts(user_id: int):
 def remove_dm_contact(user_id: int, other_id: int):
     with get_conn() as c:
         c.execute("DELETE FROM dm_contacts WHERE user_id = ? AND other_id = ?", (user_id, other_id))
+
+# ---------- Anexos (armazenamento por conteúdo) ----------
+def register_attachment(sha256: str, url: str, mime: str, size: int, place_file):
+    """Registra o anexo (ou renova um já existente) e chama `place_file()` na mesma transação.
+
+    Como a transação já segura o lock de escrita do banco, o arquivo nunca é
+    colocado no disco ao mesmo tempo em que a coleta de lixo o remove.
+    """
+    now = datetime.utcnow().isoformat()
+    with get_conn() as c:
+        row = c.execute("""
+            INSERT INTO attachments (sha256, url, mime, size, refcount, created_at, last_seen_at)
+            VALUES (?, ?, ?, ?, 0, ?, ?)
+            ON CONFLICT(sha256) DO UPDATE SET last_seen_at = excluded.last_seen_at
+            RETURNING *
+        """, (sha256, url, mime, size, now, now)).fetchone()
+        place_file()
+        return dict(row)
+
+def set_attachment_variants(sha256: str, thumb_url=None, webp_url=None):
+    """Grava as variantes no anexo e nas mensagens que já apontam para ele."""
+    with get_conn() as c:
+        row = c.execute("""
+            UPDATE attachments SET thumb_url = ?, webp_url = ?, variants_done = 1
+            WHERE sha256 = ?
+            RETURNING url
+        """, (thumb_url, webp_url, sha256)).fetchone()
+        if row:
+            c.execute("""
+                UPDATE messages SET attachment_thumb_url = ?, attachment_webp_url = ?
+                WHERE attachment_url = ?
+            """, (thumb_url, webp_url, row[0]))
+    if row and history_cache is not None:
+        history_cache.on_attachment_variants(row[0], thumb_url, webp_url)
+
+def attachments_missing_variants(limit: int = 1000) -> list:
+    with get_conn() as c:
+        rows = c.execute("""
+            SELECT sha256, url FROM attachments
+            WHERE variants_done = 0 AND mime LIKE 'image/%'
+            LIMIT ?
+        """, (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+def known_attachments(hashes) -> set:
+    """Quais destes sha256 têm linha em `attachments`."""
+    hashes = list(hashes)
+    if not hashes:
+        return set()
+    with get_conn() as c:
+        marks = ",".join("?" * len(hashes))
+        return {r[0] for r in c.execute(f"SELECT sha256 FROM attachments WHERE sha256 IN ({marks})", hashes)}
+
+def orphan_attachments(cutoff: str) -> list:
+    with get_conn() as c:
+        rows = c.execute("""
+            SELECT url, size, last_seen_at FROM attachments
+            WHERE refcount <= 0 AND last_seen_at < ?
+        """, (cutoff,)).fetchall()
+        return [dict(r) for r in rows]
+
+def delete_orphan_attachments(cutoff: str, remove_file, batch: int = 200) -> list:
+    """Apaga anexos sem referência vistos pela última vez antes de `cutoff`.
+
+    Linha e arquivo (`remove_file(url)`) saem na mesma transação; devolve as URLs.
+    """
+    removed = []
+    while True:
+        with get_conn() as c:
+            rows = c.execute("""
+                SELECT sha256, url, thumb_url, webp_url FROM attachments
+                WHERE refcount <= 0 AND last_seen_at < ?
+                LIMIT ?
+            """, (cutoff, batch)).fetchall()
+            for sha256, url, *variants in rows:
+                cur = c.execute(
+                    "DELETE FROM attachments WHERE sha256 = ? AND refcount <= 0 AND last_seen_at < ?",
+                    (sha256, cutoff)
+                )
+                if cur.rowcount:
+                    for u in [url, *variants]:
+                        if u:
+                            remove_file(u)
+                    removed.append(url)
+        if len(rows) < batch:
+            return removed
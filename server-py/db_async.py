@@ -0,0 +1,155 @@
+"""API assíncrona do banco para os handlers Socket.IO.
+
+Expõe as mesmas funções públicas de `db.py` como corrotinas. As chamadas
+bloqueantes rodam num executor dedicado (do tamanho do pool de conexões),
+então uma escrita lenta ou um checkpoint do WAL não trava o event loop:
+
+    import db_async as adb
+    rooms = await adb.list_my_rooms(uid)
+
+As mensagens novas passam pelo `message_writer`, que agrupa os INSERTs
+concorrentes numa transação só (group commit).
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import db
+
+DB_WRITE_BATCH_MS = float(os.getenv("DB_WRITE_BATCH_MS", "2"))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "256"))
+
+_executor = ThreadPoolExecutor(max_workers=db.DB_POOL_SIZE, thread_name_prefix="db")
+_wrapped: dict = {}
+
+async def run(fn, *args, **kwargs):
+    """Executa `fn` no executor do banco e aguarda o resultado."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+def _wrap(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+    return wrapper
+
+def __getattr__(name: str):
+    if name.startswith("_"):
+        raise AttributeError(name)
+    fn = _wrapped.get(name)
+    if fn is None:
+        target = getattr(db, name, None)
+        if not callable(target) or isinstance(target, type):
+            raise AttributeError(f"module 'db_async' has no attribute '{name}'")
+        fn = _wrapped[name] = _wrap(target)
+    return fn
+
+# =========================
+# Escrita em lote das mensagens
+# =========================
+class MessageWriter:
+    """Escritor único que junta as mensagens enviadas ao mesmo tempo num commit.
+
+    Cada `insert_*` entra na fila e espera o futuro dela; o escritor junta o
+    que chegou em `window` ms (no máximo `max_batch`), grava tudo com
+    `db.insert_messages_batch` e só resolve os futuros depois do commit, então
+    o ack do remetente continua significando "está no disco". Enquanto um lote
+    grava, o próximo vai se formando. Sem `start()` (scripts), insere direto.
+    """
+
+    def __init__(self, window_ms: float = DB_WRITE_BATCH_MS, max_batch: int = DB_WRITE_BATCH_MAX):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Future] = None
+        self.batches = 0
+        self.messages = 0
+        self.max_seen = 0
+
+    async def _submit(self, item: dict) -> dict:
+        if self._task is None:
+            return (await run(db.insert_messages_batch, [item]))[0]
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        result = await fut
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def insert_room_message(self, room_id: int, sender_id: int, content: str,
+                                  attachment_url=None, attachment_type=None) -> dict:
+        return await self._submit({"kind": "room", "room_id": room_id, "sender_id": sender_id, "content": content,
+                                   "attachment_url": attachment_url, "attachment_type": attachment_type})
+
+    async def insert_dm(self, sender_id: int, recipient_id: int, content: str,
+                        attachment_url=None, attachment_type=None) -> dict:
+        return await self._submit({"kind": "dm", "recipient_id": recipient_id, "sender_id": sender_id,
+                                   "content": content, "attachment_url": attachment_url,
+                                   "attachment_type": attachment_type})
+
+    async def _write(self, batch: list):
+        try:
+            results = await run(db.insert_messages_batch, [item for item, _ in batch])
+        except Exception as e:  # o lote inteiro falhou (ex.: banco travado)
+            results = [e] * len(batch)
+        self.batches += 1
+        self.messages += len(batch)
+        self.max_seen = max(self.max_seen, len(batch))
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                if self.window > 0:
+                    await asyncio.sleep(self.window)
+            finally:
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                # o lote já saiu da fila: grava mesmo se o stop() cancelar no meio
+                self._inflight = asyncio.ensure_future(self._write(batch))
+                await asyncio.shield(self._inflight)
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Para de aceitar lotes novos e grava o que ainda estava na fila."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        if self._inflight is not None:
+            await self._inflight
+        self._task = None
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        if pending:
+            await self._write(pending)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": (self.messages / self.batches) if self.batches else 0.0,
+            "max_batch": self.max_seen,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+message_writer = MessageWriter()
+
+def shutdown():
+    """Espera as chamadas em andamento e encerra as threads (um uso posterior cria outras)."""
+    global _executor
+    old, _executor = _executor, ThreadPoolExecutor(max_workers=db.DB_POOL_SIZE, thread_name_prefix="db")
+    old.shutdown(wait=True)
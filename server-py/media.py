@@ -0,0 +1,154 @@
+"""Variantes de imagem (miniatura e WebP) geradas em segundo plano.
+
+Depois do upload, o anexo entra numa fila; workers assíncronos tiram os jobs
+e mandam a decodificação/codificação para um pool de processos, longe do
+event loop. Quando as variantes ficam prontas, as URLs são gravadas no anexo
+e nas mensagens que já o usam; mensagens novas as recebem no INSERT.
+Enquanto isso (ou se o Pillow não estiver instalado) o cliente usa o original.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import db_async as adb
+import uploads
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional: sem ele não há variantes
+    Image = ImageOps = None
+
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_QUEUE_SIZE = int(os.getenv("MEDIA_QUEUE_SIZE", "1000"))
+MEDIA_THUMB_SIZE = int(os.getenv("MEDIA_THUMB_SIZE", "480"))
+MEDIA_WEBP_SIZE = int(os.getenv("MEDIA_WEBP_SIZE", "1600"))
+MEDIA_WEBP_QUALITY = int(os.getenv("MEDIA_WEBP_QUALITY", "80"))
+
+log = logging.getLogger(__name__)
+
+# nome da variante -> (lado máximo em px, coluna em attachments)
+VARIANTS = {
+    "thumb": (MEDIA_THUMB_SIZE, "thumb_url"),
+    "large": (MEDIA_WEBP_SIZE, "webp_url"),
+}
+
+def enabled() -> bool:
+    return Image is not None
+
+def render_variants(src: str, dest_prefix: str) -> dict:
+    """Gera as variantes de `src` em `<dest_prefix>.<nome>.webp` (roda no pool).
+
+    Devolve {nome: caminho}; a variante "large" é pulada quando não reduziria
+    nada (original já em WebP e dentro do tamanho).
+    """
+    out = {}
+    with Image.open(src) as im:
+        im.seek(0)  # GIF/WebP animados: primeiro quadro
+        frame = ImageOps.exif_transpose(im)
+        if frame.mode not in ("RGB", "RGBA"):
+            frame = frame.convert("RGBA" if "A" in frame.getbands() or "transparency" in im.info else "RGB")
+        for name, (max_side, _) in VARIANTS.items():
+            if name == "large" and im.format == "WEBP" and max(frame.size) <= max_side:
+                continue
+            variant = frame.copy()
+            variant.thumbnail((max_side, max_side), Image.LANCZOS)
+            dest = f"{dest_prefix}.{name}.webp"
+            tmp = f"{dest}.{os.getpid()}.tmp"
+            variant.save(tmp, "WEBP", quality=MEDIA_WEBP_QUALITY, method=4)
+            os.replace(tmp, dest)
+            out[name] = dest
+    return out
+
+class MediaQueue:
+    def __init__(self, workers: int = MEDIA_WORKERS, maxsize: int = MEDIA_QUEUE_SIZE):
+        self.workers = workers
+        self._queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=maxsize)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: list = []
+        self._pending: set = set()  # sha256 na fila ou sendo processados
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    def submit(self, attachment: dict) -> bool:
+        """Agenda as variantes de um anexo ({sha256, url}); False se não coube."""
+        if not enabled() or not self._tasks:
+            return False
+        sha = attachment["sha256"]
+        if sha in self._pending:  # mesmo arquivo reenviado: as variantes já vêm
+            self.duplicates += 1
+            return True
+        try:
+            self._queue.put_nowait(attachment)
+            self._pending.add(sha)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1  # fica só o original; o próximo restart reprocessa
+            return False
+
+    async def _process(self, job: dict):
+        src = uploads.url_to_path(job["url"])
+        if src is None or not src.exists():
+            return
+        prefix = str(src.parent / job["sha256"])
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(self._executor, render_variants, str(src), prefix)
+        urls = {
+            VARIANTS[name][1]: f"{uploads.UPLOAD_URL_PREFIX}/{Path(path).relative_to(uploads.UPLOAD_DIR).as_posix()}"
+            for name, path in files.items()
+        }
+        await adb.set_attachment_variants(job["sha256"], urls.get("thumb_url"), urls.get("webp_url"))
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+                self.done += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                log.exception("falha ao gerar variantes de %s", job.get("url"))
+                try:  # não insiste em imagem quebrada a cada restart
+                    await adb.set_attachment_variants(job["sha256"])
+                except Exception:
+                    log.warning("falha ao marcar %s como sem variantes", job.get("url"), exc_info=True)
+            finally:
+                self._pending.discard(job["sha256"])
+                self._queue.task_done()
+
+    async def start(self):
+        if not enabled():
+            log.warning("Pillow não instalado: miniaturas desativadas")
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # retoma anexos que ficaram sem variantes (fila cheia, restart no meio)
+        for att in await adb.attachments_missing_variants(self._queue.maxsize):
+            self.submit(att)
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": enabled(),
+            "queued": self._queue.qsize(),
+            "done": self.done,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "duplicates": self.duplicates,
+        }
+
+media_queue = MediaQueue()
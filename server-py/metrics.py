@@ -0,0 +1,288 @@
+"""Métricas no formato texto do Prometheus, sem dependências.
+
+Contadores e histogramas são atualizados no caminho quente (um lock curto e
+um bisect por observação); gauges e estatísticas dos outros módulos são
+lidos só na hora do scrape, via `collector`:
+
+    REQUESTS = metrics.counter("chat_x_total", "Descrição", ["label"])
+    REQUESTS.inc("valor")
+    print(metrics.render())
+"""
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def _fmt(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()  # db.* roda nas threads do executor
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict = {}
+
+    def inc(self, *labels, value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+class Gauge(_Metric):
+    """Valor lido no scrape: `fn()` devolve um número ou {labels: número}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def render(self) -> list:
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}"
+                                for k, v in items if v is not None]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict = {}  # labels -> [contagem por bucket..., +Inf], soma
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][i] += 1
+            s[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list:
+        with self._lock:
+            series = [(k, list(counts), total) for k, (counts, total) in self._series.items()]
+        out = self.header()
+        for labels, counts, total in series:
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                le = 'le="%s"' % _fmt(bound)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {acc}")
+        return out
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist: Histogram, labels: tuple):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+# =========================
+# Registro
+# =========================
+_registry: list = []
+_collectors: list = []
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+def counter(name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+    return _register(Counter(name, help, labelnames))
+
+def histogram(name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, labelnames, buckets))
+
+def gauge(name: str, help: str, fn: Callable, labelnames: Iterable[str] = ()) -> Gauge:
+    return _register(Gauge(name, help, fn, labelnames))
+
+def collector(prefix: str, fn: Callable[[], dict]):
+    """Exporta cada número de `fn()` (ex.: `pool_stats()`) como gauge `<prefix>_<chave>`.
+
+    Dicts aninhados viram `<prefix>_<chave>_<subchave>`; texto é ignorado.
+    """
+    _collectors.append((prefix, fn))
+
+def _flatten(prefix: str, stats: dict):
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from _flatten(name, value)
+        elif isinstance(value, (bool, int, float)):
+            yield name, float(value) if isinstance(value, bool) else value
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        try:
+            lines += metric.render()
+        except Exception as e:  # um gauge quebrado não derruba o scrape inteiro
+            lines.append(f"# erro em {metric.name}: {e!r}")
+    for prefix, fn in _collectors:
+        try:
+            for name, value in _flatten(prefix, fn()):
+                lines += [f"# TYPE {name} gauge", f"{name} {_fmt(value)}"]
+        except Exception as e:
+            lines.append(f"# erro em {prefix}: {e!r}")
+    return "\n".join(lines) + "\n"
+
+# =========================
+# Instrumentação
+# =========================
+HTTP_LATENCY = histogram("chat_http_request_duration_seconds", "Latência das rotas HTTP", ["method", "route"])
+HTTP_REQUESTS = counter("chat_http_requests_total", "Requisições HTTP por status", ["method", "route", "status"])
+SOCKET_LATENCY = histogram("chat_socket_event_duration_seconds", "Latência dos eventos Socket.IO", ["event"])
+SOCKET_ERRORS = counter("chat_socket_event_errors_total", "Eventos Socket.IO que levantaram exceção", ["event"])
+DB_LATENCY = histogram("chat_db_call_duration_seconds", "Duração das funções de db.py", ["fn"])
+DB_ERRORS = counter("chat_db_call_errors_total", "Funções de db.py que levantaram exceção", ["fn"])
+LOOP_LAG = histogram("chat_event_loop_lag_seconds", "Atraso do event loop (sleep agendado vs. real)")
+
+class HTTPMetricsMiddleware:
+    """Middleware ASGI: latência e status por rota (o template, não o path cru)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                label = route.path
+            elif scope.get("endpoint") is not None:
+                label = scope.get("root_path") or "other"  # app montado (/uploads): um rótulo só
+            else:
+                label = "other"  # 404: não cria uma série por path inventado
+            HTTP_LATENCY.observe(time.perf_counter() - start, scope["method"], label)
+            HTTP_REQUESTS.inc(scope["method"], label, str(status[0]))
+
+def socket_event(name: str):
+    """Decorator para handlers do Socket.IO: latência e erros por evento."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                SOCKET_ERRORS.inc(name)
+                raise
+            finally:
+                SOCKET_LATENCY.observe(time.perf_counter() - start, name)
+        return wrapper
+    return deco
+
+def _timed(name: str, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - start, name)
+    wrapper.__wrapped_metrics__ = True
+    return wrapper
+
+def instrument_module(module, skip: Iterable[str] = ()):
+    """Troca cada função pública de `module` por uma versão cronometrada.
+
+    A contagem de chamadas sai do `_count` do histograma. Chame antes do
+    primeiro uso via `db_async`, que guarda as funções na primeira chamada.
+    """
+    skip = set(skip)
+    for name, obj in list(vars(module).items()):
+        if (name.startswith("_") or name in skip or not inspect.isfunction(obj)
+                or obj.__module__ != module.__name__ or getattr(obj, "__wrapped_metrics__", False)):
+            continue
+        setattr(module, name, _timed(name, obj))
+
+class LoopLagMonitor:
+    """Mede o atraso do event loop: dorme `interval` e vê quanto passou a mais."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - start - self.interval)
+            LOOP_LAG.observe(self.last)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+loop_lag = LoopLagMonitor()
+gauge("chat_event_loop_lag_last_seconds", "Último atraso medido do event loop", lambda: loop_lag.last)
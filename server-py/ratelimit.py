@@ -0,0 +1,122 @@
+"""Limite de taxa (token bucket) para eventos do socket e uploads.
+
+Cada chave (sid ou id do usuário) tem um balde com até `burst` fichas que
+se repõe a `rate` fichas/s; cada evento gasta uma. O estado por chave são
+dois floats, e baldes que já se encheram de novo são descartados numa
+varredura periódica, então a memória acompanha só quem está ativo.
+
+O limite vale por processo: com vários workers, cada um aplica o seu.
+"""
+import os
+import time
+from typing import Iterable, Optional
+
+RATE_SOCKET_PER_SEC = float(os.getenv("RATE_SOCKET_PER_SEC", "5"))
+RATE_SOCKET_BURST = float(os.getenv("RATE_SOCKET_BURST", "10"))
+RATE_USER_PER_SEC = float(os.getenv("RATE_USER_PER_SEC", "8"))
+RATE_USER_BURST = float(os.getenv("RATE_USER_BURST", "20"))
+RATE_UPLOAD_PER_SEC = float(os.getenv("RATE_UPLOAD_PER_SEC", "0.5"))
+RATE_UPLOAD_BURST = float(os.getenv("RATE_UPLOAD_BURST", "5"))
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: float, sweep_every: float = 60.0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.sweep_every = sweep_every
+        self._buckets: dict = {}  # chave -> [fichas, último acesso]
+        self._next_sweep = time.monotonic() + sweep_every
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self, key, now: float) -> list:
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = [self.burst, now]
+        else:
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        return b
+
+    def wait_time(self, key, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Segundos até haver `cost` fichas para `key` (0 = pode agora)."""
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        tokens = self._refill(key, now)[0]
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    def consume(self, key, cost: float = 1.0):
+        if self.enabled:
+            self._buckets[key][0] -= cost
+        self.allowed += 1
+
+    def take(self, key, cost: float = 1.0) -> float:
+        """Gasta `cost` fichas; devolve 0 ou quantos segundos esperar."""
+        return take_all([(self, key)], cost)
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
+
+    def sweep(self, now: Optional[float] = None):
+        """Remove os baldes cheios (chaves ociosas); O(n), mas só a cada `sweep_every` s."""
+        now = time.monotonic() if now is None else now
+        self._next_sweep = now + self.sweep_every
+        for key in [k for k, (tokens, last) in self._buckets.items()
+                    if tokens + (now - last) * self.rate >= self.burst]:
+            del self._buckets[key]
+
+    def maybe_sweep(self, now: float):
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "keys": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+def take_all(checks: Iterable[tuple], cost: float = 1.0) -> float:
+    """Gasta de todos os baldes `(limiter, chave)` ou de nenhum.
+
+    Devolve 0 se passou; senão o maior tempo de espera entre os baldes que
+    recusaram (o `retry_after` para o cliente).
+    """
+    checks = list(checks)
+    now = time.monotonic()
+    wait = 0.0
+    for limiter, key in checks:
+        limiter.maybe_sweep(now)
+        w = limiter.wait_time(key, cost, now)
+        if w > 0:
+            limiter.limited += 1
+            wait = max(wait, w)
+    if wait > 0:
+        return wait
+    for limiter, key in checks:
+        limiter.consume(key, cost)
+    return 0.0
+
+def limited_ack(retry_after: float) -> dict:
+    """Erro padrão nos acks do socket quando o limite estoura."""
+    return {
+        "ok": False,
+        "error": "Muitas requisições, aguarde um pouco",
+        "code": "rate_limited",
+        "retry_after": round(retry_after, 2),
+    }
+
+# eventos de qualquer tipo por conexão, e por usuário somando todas as abas
+socket_limiter = TokenBucket("socket", RATE_SOCKET_PER_SEC, RATE_SOCKET_BURST)
+user_limiter = TokenBucket("user", RATE_USER_PER_SEC, RATE_USER_BURST)
+upload_limiter = TokenBucket("upload", RATE_UPLOAD_PER_SEC, RATE_UPLOAD_BURST)
+
+def stats() -> dict:
+    return {lim.name: lim.stats() for lim in (socket_limiter, user_limiter, upload_limiter)}
@@ -0,0 +1,512 @@
+"""Uploads: recebimento em streaming e armazenamento por conteúdo.
+
+O corpo multipart é lido direto do ASGI, pedaço por pedaço: o tipo é
+identificado pelos primeiros bytes, o hash é calculado enquanto grava e o
+upload é abortado assim que passa de `UPLOAD_MAX_BYTES`. A memória usada
+por upload é constante (um chunk), seja qual for o tamanho do arquivo.
+
+Cada arquivo é guardado uma vez só, pelo sha256, em `uploads/ab/cd/<sha256>.<ext>`;
+reenviar a mesma imagem devolve a mesma URL. A tabela `attachments` conta as
+mensagens que apontam para cada arquivo e a coleta de lixo remove os órfãos:
+
+    python uploads.py gc [--grace 3600] [--dry-run]
+"""
+import argparse
+import asyncio
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import filetype
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+import db
+import db_async as adb
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", str(Path(__file__).parent / "uploads")))
+UPLOAD_URL_PREFIX = "/uploads"
+UPLOAD_GC_GRACE_SECONDS = int(os.getenv("UPLOAD_GC_GRACE_SECONDS", "3600"))
+UPLOAD_HOT_CACHE_BYTES = int(os.getenv("UPLOAD_HOT_CACHE_BYTES", str(64 * 1024 * 1024)))
+UPLOAD_HOT_FILE_MAX = int(os.getenv("UPLOAD_HOT_FILE_MAX", str(512 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
+SNIFF_BYTES = 262  # o filetype precisa de no máximo isso para reconhecer o formato
+_MULTIPART_OVERHEAD = 16 * 1024  # cabeçalhos das partes + boundaries
+
+class UploadError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+def _too_large(max_bytes: int) -> UploadError:
+    return UploadError(413, f"Arquivo maior que {round(max_bytes / (1024 * 1024), 1):g} MB")
+
+class _FilePart:
+    """Estado da parte `file` enquanto o parser entrega os bytes."""
+
+    def __init__(self, field: str, tmp_dir: Path, max_bytes: int):
+        self.field = field
+        self.tmp_dir = tmp_dir
+        self.max_bytes = max_bytes
+        self.filename: Optional[str] = None
+        self.kind = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.path: Optional[Path] = None
+        self._fh = None
+        self._head = b""
+        self._pending: list = []  # bytes recebidos desde o último flush
+        self.done = False
+
+    # ---- chamados pelo parser (síncronos) ----
+    def begin(self, filename: str):
+        self.filename = filename
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in IMAGE_EXTS:
+            raise UploadError(400, "Apenas imagens (png, jpg, jpeg, gif, webp)")
+
+    def data(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise _too_large(self.max_bytes)
+        self.sha256.update(chunk)
+        if self.kind is None:
+            self._head += chunk
+            if len(self._head) >= SNIFF_BYTES:
+                self._sniff()
+        self._pending.append(chunk)
+
+    def end(self):
+        if self.kind is None:
+            self._sniff()
+        self.done = True
+
+    def _sniff(self):
+        kind = filetype.guess(self._head)
+        if not kind or not kind.mime.startswith("image/"):
+            raise UploadError(400, "Arquivo não reconhecido como imagem")
+        self.kind = kind
+        self._head = b""
+
+    # ---- E/S de disco (fora do event loop) ----
+    def _write_pending(self, chunks: list):
+        if self._fh is None:
+            self.path = self.tmp_dir / f".{uuid.uuid4().hex}.part"
+            self._fh = open(self.path, "wb")
+        for chunk in chunks:
+            self._fh.write(chunk)
+
+    async def flush(self):
+        # só grava depois de confirmar que é imagem
+        if self._pending and self.kind is not None:
+            chunks, self._pending = self._pending, []
+            await asyncio.to_thread(self._write_pending, chunks)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def discard(self):
+        self.close()
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+
+async def receive_image(request: Request, tmp_dir: Path, field: str = "file",
+                        max_bytes: int = UPLOAD_MAX_BYTES) -> dict:
+    """Lê o multipart da requisição e grava a imagem num arquivo temporário.
+
+    Devolve {path, size, sha256, mime, ext, filename}; quem chama decide o
+    destino final e apaga `path` se não for usá-lo. Erros viram UploadError.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError(400, "Envie o arquivo como multipart/form-data")
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > max_bytes + _MULTIPART_OVERHEAD:
+        raise _too_large(max_bytes)
+
+    part = _FilePart(field, tmp_dir, max_bytes)
+    state = {"header_field": b"", "headers": {}, "active": False}
+
+    def on_part_begin():
+        state["headers"] = {}
+        state["active"] = False
+
+    def on_header_field(data: bytes, start: int, end: int):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        key = state["header_field"].lower()
+        state["headers"][key] = state["headers"].get(key, b"") + data[start:end]
+
+    def on_header_end():
+        state["header_field"] = b""
+
+    def on_headers_finished():
+        _, disp = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = disp.get(b"name", b"").decode("latin-1")
+        filename = disp.get(b"filename")
+        if name == field and filename is not None and not part.done and part.filename is None:
+            part.begin(filename.decode("utf-8", "replace"))
+            state["active"] = True
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if state["active"]:
+            part.data(data[start:end])
+
+    def on_part_end():
+        if state["active"]:
+            part.end()
+            state["active"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            await part.flush()
+        parser.finalize()
+        await part.flush()
+        if not part.done:
+            raise UploadError(400, "Nenhum arquivo enviado")
+        if part.path is None:  # arquivo vazio não passa no sniff; por garantia
+            raise UploadError(400, "Arquivo vazio")
+    except BaseException:
+        part.discard()
+        raise
+    part.close()
+
+    ext = f".{part.kind.extension}" if part.kind.extension else os.path.splitext(part.filename)[1].lower()
+    return {
+        "path": part.path,
+        "size": part.size,
+        "sha256": part.sha256.hexdigest(),
+        "mime": part.kind.mime,
+        "ext": ext,
+        "filename": part.filename,
+    }
+
+# =========================
+# Armazenamento por conteúdo
+# =========================
+def content_path(sha256: str, ext: str) -> str:
+    """Caminho relativo (em shards de 2 níveis) de um conteúdo."""
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+def url_to_path(url: str) -> Optional[Path]:
+    prefix = UPLOAD_URL_PREFIX + "/"
+    if not url.startswith(prefix):
+        return None
+    path = (UPLOAD_DIR / url[len(prefix):]).resolve()
+    return path if path.is_relative_to(UPLOAD_DIR.resolve()) else None
+
+async def store(saved: dict) -> dict:
+    """Move o arquivo recebido para o endereço do seu conteúdo (deduplicado).
+
+    Devolve a linha de `attachments` (url, mime, variantes...)."""
+    rel = content_path(saved["sha256"], saved["ext"])
+    url = f"{UPLOAD_URL_PREFIX}/{rel}"
+    dest = UPLOAD_DIR / rel
+    tmp = saved["path"]
+
+    def place_file():
+        if dest.exists():
+            tmp.unlink(missing_ok=True)  # mesmo conteúdo já guardado
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, dest)
+
+    try:
+        return await adb.register_attachment(saved["sha256"], url, saved["mime"], saved["size"], place_file)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+# =========================
+# Entrega (/uploads)
+# =========================
+# Nomes de arquivo nunca são reaproveitados (sha256 ou uuid), então o conteúdo
+# de uma URL não muda: o navegador pode guardar para sempre e revalidar de graça.
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+_SEND_CHUNK = 256 * 1024
+
+class HotFileCache:
+    """LRU em memória dos arquivos pequenos mais pedidos, limitado em bytes."""
+
+    def __init__(self, max_bytes: int = UPLOAD_HOT_CACHE_BYTES, max_file: int = UPLOAD_HOT_FILE_MAX):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.bytes = 0
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_file or self.max_bytes <= 0:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self.bytes -= len(old)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"files": len(self._items), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range(value: Optional[str], size: int) -> Optional[tuple]:
+    """(início, fim inclusive) de um Range de faixa única.
+
+    None = servir o arquivo inteiro (sem Range, malformado ou várias faixas,
+    o que a RFC 9110 permite); RangeNotSatisfiable = responder 416.
+    """
+    if not value:
+        return None
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:  # "-N": últimos N bytes
+            n = int(last)
+            if n <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - n), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+class UploadsApp:
+    """App ASGI que serve /uploads com cache imutável, ETag forte e Range.
+
+    Usa envio zero-copy quando o servidor ASGI oferece a extensão
+    (`http.response.zerocopysend` / `http.response.pathsend`); senão lê em
+    blocos fora do event loop. Arquivos pequenos ficam no HotFileCache.
+    """
+
+    def __init__(self, directory: Path, hot_cache: Optional[HotFileCache] = None):
+        self.directory = Path(directory).resolve()
+        self.hot_cache = hot_cache if hot_cache is not None else HotFileCache()
+        self.bytes_sent = 0
+
+    def _resolve(self, scope) -> Optional[Path]:
+        path = scope["path"]
+        root = scope.get("root_path", "")
+        if root and path.startswith(root):
+            path = path[len(root):]
+        parts = [p for p in path.split("/") if p]
+        # nada de "..", nem arquivos ocultos (.part dos uploads em andamento)
+        if not parts or any(p.startswith(".") for p in parts):
+            return None
+        full = self.directory.joinpath(*parts)
+        try:
+            full = full.resolve()
+            full.relative_to(self.directory)
+        except (ValueError, OSError):
+            return None
+        return full
+
+    @staticmethod
+    async def _respond(send, status: int, headers: list, body: bytes = b""):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            await self._respond(send, 405, [(b"allow", b"GET, HEAD"), (b"content-length", b"0")])
+            return
+        path = self._resolve(scope)
+        try:
+            st = await asyncio.to_thread(os.stat, path) if path is not None else None
+        except OSError:
+            st = None
+        if st is None or not os.path.isfile(path):
+            await self._respond(send, 404, [(b"content-type", b"text/plain"), (b"content-length", b"9")], b"Not Found")
+            return
+
+        size = st.st_size
+        etag = f'"{path.name}"'  # nome único e imutável: ETag forte de graça
+        req = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        headers = [
+            (b"cache-control", CACHE_CONTROL.encode()),
+            (b"etag", etag.encode()),
+            (b"accept-ranges", b"bytes"),
+            (b"x-content-type-options", b"nosniff"),
+        ]
+
+        inm = req.get("if-none-match")
+        if inm and (inm.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in inm.split(",")]):
+            await self._respond(send, 304, headers)
+            return
+
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        headers.append((b"content-type", content_type.encode()))
+
+        byte_range = None
+        if_range = req.get("if-range")
+        if if_range is None or if_range.strip() == etag:
+            try:
+                byte_range = parse_range(req.get("range"), size)
+            except RangeNotSatisfiable:
+                headers.append((b"content-range", f"bytes */{size}".encode()))
+                headers.append((b"content-length", b"0"))
+                await self._respond(send, 416, headers)
+                return
+
+        status, start, end = 200, 0, size - 1
+        if byte_range is not None:
+            status, (start, end) = 206, byte_range
+            headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+        length = max(0, end - start + 1)
+        headers.append((b"content-length", str(length).encode()))
+
+        if scope["method"] == "HEAD":
+            await self._respond(send, status, headers)
+            return
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await self._send_body(scope, send, path, size, start, length)
+        self.bytes_sent += length
+
+    async def _send_body(self, scope, send, path: Path, size: int, start: int, length: int):
+        key = str(path)
+        data = self.hot_cache.get(key)
+        if data is None and size <= self.hot_cache.max_file:
+            data = await asyncio.to_thread(path.read_bytes)
+            self.hot_cache.put(key, data)
+        if data is not None:
+            await send({"type": "http.response.body", "body": data[start:start + length]})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            with open(path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(),
+                            "offset": start, "count": length})
+            return
+        if "http.response.pathsend" in extensions and start == 0 and length == size:
+            await send({"type": "http.response.pathsend", "path": str(path)})
+            return
+
+        f = await asyncio.to_thread(open, path, "rb")
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = length
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(_SEND_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:  # arquivo encolheu no meio: fecha a resposta mesmo assim
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            f.close()
+
+    def stats(self) -> dict:
+        return {"bytes_sent": self.bytes_sent, "hot_cache": self.hot_cache.stats()}
+
+# =========================
+# Coleta de lixo
+# =========================
+def _remove_file(path: Path):
+    path.unlink(missing_ok=True)
+    if path.parent == UPLOAD_DIR:
+        return
+    for parent in (path.parent, path.parent.parent):
+        try:
+            parent.rmdir()  # só sai se o shard ficou vazio
+        except OSError:
+            break
+
+def _remove_url(url: str):
+    path = url_to_path(url)
+    if path is not None:
+        _remove_file(path)
+
+def _stray_files(older_than: float):
+    """Arquivos nos shards (originais e variantes) sem anexo registrado e .part abandonados."""
+    for tmp in UPLOAD_DIR.glob(".*.part"):
+        if tmp.stat().st_mtime < older_than:
+            yield tmp
+    for shard in UPLOAD_DIR.glob("[0-9a-f][0-9a-f]/[0-9a-f][0-9a-f]"):
+        # o nome de todo arquivo do shard começa com o sha256 do conteúdo original
+        files = [p for p in shard.iterdir() if p.is_file() and p.stat().st_mtime < older_than]
+        known = db.known_attachments({p.name[:64] for p in files})
+        for path in files:
+            if path.name[:64] not in known:
+                yield path
+
+def gc(grace_seconds: int = UPLOAD_GC_GRACE_SECONDS, dry_run: bool = False) -> dict:
+    """Remove anexos sem mensagens há mais de `grace_seconds` (o upload
+    acontece antes do envio da mensagem, então arquivos novos são poupados)."""
+    cutoff = (datetime.utcnow() - timedelta(seconds=grace_seconds)).isoformat()
+    if dry_run:
+        orphans = [o["url"] for o in db.orphan_attachments(cutoff)]
+    else:
+        orphans = db.delete_orphan_attachments(cutoff, _remove_url)
+    strays = []
+    for path in _stray_files(time.time() - grace_seconds):
+        strays.append(str(path))
+        if not dry_run:
+            _remove_file(path)
+    return {"orphans": orphans, "strays": strays, "dry_run": dry_run}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manutenção dos uploads")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_gc = sub.add_parser("gc", help="remove anexos órfãos")
+    p_gc.add_argument("--grace", type=int, default=UPLOAD_GC_GRACE_SECONDS,
+                      help="idade mínima (s) de um órfão para ser removido")
+    p_gc.add_argument("--dry-run", action="store_true", help="só lista o que seria removido")
+    args = parser.parse_args(argv)
+
+    db.init_db()
+    if args.cmd == "gc":
+        result = gc(args.grace, args.dry_run)
+        verb = "seriam removidos" if args.dry_run else "removidos"
+        print(f"{len(result['orphans'])} anexos órfãos e {len(result['strays'])} arquivos soltos {verb}")
+        for item in result["orphans"] + result["strays"]:
+            print(f"  {item}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Payloads compactos do Socket.IO: msgpack opcional, negociado por cliente.
+
+O serializer do python-socketio vale para o servidor inteiro, então a
+negociação fica na camada da aplicação: o cliente pede `format: "msgpack"`
+no auth do connect e passa a entrar nas salas `<sala>#mp` em vez das
+originais. `message:new` e `message:batch` chegam a ele como um único anexo
+binário (bytes msgpack); os demais eventos continuam JSON para todos.
+
+Os payloads saem sem os campos None, e cada um é codificado uma vez por
+emit: com uma lista de salas, o manager gera o pacote uma vez só e o
+reaproveita para todos os sockets.
+"""
+import os
+from typing import Iterable
+
+try:
+    import msgpack
+except ImportError:  # opcional: sem ele todo cliente recebe JSON
+    msgpack = None
+
+SOCKET_MSGPACK_ENABLED = os.getenv("SOCKET_MSGPACK_ENABLED", "1") == "1"
+
+JSON = "json"
+MSGPACK = "msgpack"
+BINARY_SUFFIX = "#mp"
+
+def binary_available() -> bool:
+    return SOCKET_MSGPACK_ENABLED and msgpack is not None
+
+def negotiate(auth) -> str:
+    """Formato deste socket: msgpack só se o cliente pediu e o servidor tem."""
+    wanted = (auth or {}).get("format")
+    return MSGPACK if wanted == MSGPACK and binary_available() else JSON
+
+def compact(msg: dict) -> dict:
+    """Tira os campos None (anexo, destinatário, variantes...)."""
+    return {k: v for k, v in msg.items() if v is not None}
+
+def pack(data) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+def room_for(room: str, fmt: str) -> str:
+    """Nome real da sala Socket.IO para um socket no formato `fmt`."""
+    return room + BINARY_SUFFIX if fmt == MSGPACK else room
+
+def binary_rooms(rooms: Iterable[str]) -> list:
+    return [r + BINARY_SUFFIX for r in rooms]
+
+def all_rooms(rooms: Iterable[str]) -> list:
+    """As duas variantes de cada sala (eventos JSON que todos recebem)."""
+    rooms = list(rooms)
+    return rooms + binary_rooms(rooms)
@@ -36,22 +36,34 @@ export async function uploadImage(file) {
   return res.json(); // { url, type, mime }
 }
 
+function historyQuery(beforeId) {
+  return beforeId ? `?before_id=${encodeURIComponent(beforeId)}` : '';
+}
+
 export const api = {
   register: (n,e,p) => request('/register', { method:'POST', body: JSON.stringify({ name:n, email:e, password:p }) }),
   login: (e,p) => request('/login', { method:'POST', body: JSON.stringify({ email:e, password:p }) }),
+  logout: () => request('/logout', { method:'POST' }),
   me: () => request('/me'),
   rooms: () => request('/rooms'),
   createRoom: (name) => request('/rooms', { method:'POST', body: JSON.stringify({ name }) }),
   joinRoom: (roomId) => request(`/rooms/${roomId}/join`, { method:'POST' }),
   leaveRoom: (roomId) => request(`/rooms/${roomId}/leave`, { method:'POST' }),
-  roomMessages: (roomId) => request(`/messages/room/${roomId}`),
-  dmMessages: (userId) => request(`/messages/dm/${userId}`),
+  // histórico paginado: { messages, next_cursor } (next_cursor -> beforeId da próxima página)
+  roomMessages: (roomId, beforeId) => request(`/messages/room/${roomId}${historyQuery(beforeId)}`),
+  dmMessages: (userId, beforeId) => request(`/messages/dm/${userId}${historyQuery(beforeId)}`),
+  // busca full-text: { messages, next_offset }
+  searchMessages: (q, offset = 0) => request(`/messages/search?q=${encodeURIComponent(q)}&offset=${offset}`),
   findUserByEmail: (email) => request(`/users/find?email=${encodeURIComponent(email)}`),
   activeCount: () => request('/active-count'),
   // DMs salvas:
   dmList: () => request('/dm/list'),
   dmAdd: (email) => request(`/dm/add?email=${encodeURIComponent(email)}`, { method:'POST' }),
   dmRemove: (id) => request(`/dm/remove/${id}`, { method:'POST' }),
+  // não lidas: { rooms: [{id, unread, last_id, last_read_id}], dms: [...] }
+  unread: () => request('/unread'),
+  markRoomRead: (roomId) => request(`/rooms/${roomId}/read`, { method:'POST' }),
+  markDmRead: (userId) => request(`/dm/${userId}/read`, { method:'POST' }),
 };
 
 // Exporto a raiz para o chat.js (socket + imagens)
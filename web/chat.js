@@ -1,4 +1,5 @@
 import { api, uploadImage, getToken, setToken, API_ROOT_URL } from './api.js';
+import { decode as decodeMsgpack } from './msgpack.js';
 
 const token = getToken();
 if (!token) window.location.href = './auth.html';
@@ -31,6 +32,17 @@ let dms = []; // {id, name, email}
 let active = null; // {type:'room'|'dm', id, name}
 let socket = null;
 let pendingFile = null;
+let roomOnline = {}; // roomId -> membros online (presence:room)
+let historyCursor = null; // before_id da próxima página mais antiga (null = fim)
+let loadingOlder = false;
+let myId = null;
+let lastSeenId = 0; // maior id de mensagem já recebido (catch-up na reconexão)
+const recentIds = new Set(); // evita duplicar o que chega por message:new e no batch
+const unread = { room: {}, dm: {} }; // não lidas por conversa (type -> id -> n)
+
+// o socket pede as mensagens em msgpack (decoder local, ./msgpack.js);
+// localStorage chatWire = 'json' força JSON
+const useMsgpack = localStorage.getItem('chatWire') !== 'json';
 
 // ===== Emoji picker simples (sem CDN) =====
 (function setupEmoji() {
@@ -64,13 +76,21 @@ let pendingFile = null;
 })();
 
 // ===== Sidebar =====
+function unreadBadge(n) {
+  const b = document.createElement('span');
+  b.className = 'badge bg-primary rounded-pill ms-2';
+  b.textContent = n > 99 ? '99+' : String(n);
+  return b;
+}
+
 function renderRooms() {
   roomList.innerHTML = '';
   rooms.forEach(r => {
     const li = document.createElement('li');
-    li.className = 'list-group-item list-group-item-action';
+    li.className = 'list-group-item list-group-item-action d-flex justify-content-between align-items-center';
     if (active?.type === 'room' && active?.id === r.id) li.classList.add('active');
     li.textContent = `# ${r.name}`;
+    if (unread.room[r.id] > 0) li.appendChild(unreadBadge(unread.room[r.id]));
     li.style.cursor = 'pointer';
     li.onclick = () => selectRoom(r);
     roomList.appendChild(li);
@@ -87,6 +107,7 @@ function renderDMs() {
     span.textContent = u.name;
     span.style.cursor = 'pointer';
     span.onclick = () => selectDM(u);
+    if (unread.dm[u.id] > 0) span.appendChild(unreadBadge(unread.dm[u.id]));
     li.appendChild(span);
 
     const del = document.createElement('button');
@@ -111,6 +132,7 @@ function renderDMs() {
 
 function setActiveTitle() {
   activeTitle.textContent = active ? (active.type === 'room' ? `# ${active.name}` : active.name) : 'Selecione uma conversa';
+  if (active?.type === 'room' && roomOnline[active.id] != null) activeTitle.textContent += ` · ${roomOnline[active.id]} online`;
   if (active?.type === 'room') leaveBtn.classList.remove('d-none');
   else leaveBtn.classList.add('d-none');
 }
@@ -121,7 +143,21 @@ function renderMessages(msgs) {
   messageList.scrollTop = messageList.scrollHeight;
 }
 
+function prependMessages(msgs) {
+  // mantém a posição visual ao inserir mensagens antigas no topo
+  const prevHeight = messageList.scrollHeight;
+  const frag = document.createDocumentFragment();
+  msgs.forEach(m => frag.appendChild(buildMessage(m)));
+  messageList.insertBefore(frag, messageList.firstChild);
+  messageList.scrollTop += messageList.scrollHeight - prevHeight;
+}
+
 function appendMessage(m) {
+  messageList.appendChild(buildMessage(m));
+  messageList.scrollTop = messageList.scrollHeight;
+}
+
+function buildMessage(m) {
   const wrap = document.createElement('div');
   wrap.className = 'mb-3';
   const meta = document.createElement('div');
@@ -138,8 +174,12 @@ function appendMessage(m) {
   }
   if (m.attachment_type === 'image' && m.attachment_url) {
     const img = document.createElement('img');
-    // usa a raiz da API no seu IP (10.9.1.53)
-    img.src = `${API_ROOT_URL}${m.attachment_url}`;
+    // usa a raiz da API no seu IP (10.9.1.53); miniatura quando existir, senão o original
+    const original = `${API_ROOT_URL}${m.attachment_url}`;
+    img.src = m.attachment_thumb_url ? `${API_ROOT_URL}${m.attachment_thumb_url}` : original;
+    img.onerror = () => { if (img.src !== original) img.src = original; };
+    img.onclick = () => window.open(m.attachment_webp_url ? `${API_ROOT_URL}${m.attachment_webp_url}` : original, '_blank');
+    img.style.cursor = 'zoom-in';
     img.alt = 'imagem';
     img.className = 'img-thumb mt-2';
     img.style.maxWidth = '280px';
@@ -147,28 +187,94 @@ function appendMessage(m) {
     img.loading = 'lazy';
     wrap.appendChild(img);
   }
-  messageList.appendChild(wrap);
-  messageList.scrollTop = messageList.scrollHeight;
+  return wrap;
 }
 
 // ===== Ações =====
-async function selectRoom(r) {
-  active = { type: 'room', id: r.id, name: r.name };
+function fetchHistory(conv, beforeId) {
+  return conv.type === 'room' ? api.roomMessages(conv.id, beforeId) : api.dmMessages(conv.id, beforeId);
+}
+
+async function openConversation(conv) {
+  active = conv;
+  historyCursor = null;
   setActiveTitle();
-  const msgs = await api.roomMessages(r.id);
-  renderMessages(msgs);
+  const page = await fetchHistory(conv);
+  if (active !== conv) return; // trocou de conversa durante a requisição
+  historyCursor = page.next_cursor;
+  renderMessages(page.messages);
+  markRead(conv);
+  fillViewport(conv);
+}
+
+function setUnread(type, id, n) {
+  unread[type][id] = n;
+  if (type === 'room') renderRooms(); else renderDMs();
+}
+
+function markRead(conv) {
+  if (unread[conv.type][conv.id]) setUnread(conv.type, conv.id, 0);
+  const req = conv.type === 'room' ? api.markRoomRead(conv.id) : api.markDmRead(conv.id);
+  req.catch(e => console.error('Falha ao marcar como lida:', e));
+}
+
+// mensagens chegando na conversa aberta: marca como lida no máximo 1x/s
+let markReadTimer = null;
+function scheduleMarkRead() {
+  if (markReadTimer) return;
+  markReadTimer = setTimeout(() => {
+    markReadTimer = null;
+    if (active) markRead(active);
+  }, 1000);
+}
+
+async function loadOlder() {
+  if (!active || !historyCursor || loadingOlder) return;
+  const conv = active;
+  loadingOlder = true;
+  try {
+    const page = await fetchHistory(conv, historyCursor);
+    if (active !== conv) return;
+    historyCursor = page.next_cursor;
+    prependMessages(page.messages);
+  } catch (e) {
+    console.error('Falha ao carregar mensagens antigas:', e);
+  } finally {
+    loadingOlder = false;
+  }
+}
+
+// página que não enche a lista não gera barra de rolagem, e sem ela o 'scroll'
+// nunca dispara: busca mais até aparecer a barra ou acabar o histórico
+async function fillViewport(conv) {
+  while (active === conv && historyCursor && !loadingOlder
+         && messageList.scrollHeight <= messageList.clientHeight) {
+    const cursor = historyCursor;
+    await loadOlder();
+    if (historyCursor === cursor) break; // falhou: o próximo scroll tenta de novo
+  }
+}
+
+messageList.addEventListener('scroll', () => { if (messageList.scrollTop < 80) loadOlder(); });
+
+async function selectRoom(r) {
+  await openConversation({ type: 'room', id: r.id, name: r.name });
 }
 
 async function selectDM(u) {
-  active = { type: 'dm', id: u.id, name: u.name };
-  setActiveTitle();
-  const msgs = await api.dmMessages(u.id);
-  renderMessages(msgs);
+  await openConversation({ type: 'dm', id: u.id, name: u.name });
 }
 
 async function loadSidebar() {
   rooms = await api.rooms();
   dms = await api.dmList();
+  try {
+    const u = await api.unread();
+    u.rooms.forEach(r => { unread.room[r.id] = r.unread; });
+    u.dms.forEach(d => { unread.dm[d.id] = d.unread; });
+    // ponto de partida do catch-up: a mensagem mais nova que já existe
+    [...u.rooms, ...u.dms].forEach(c => { if (c.last_id > lastSeenId) lastSeenId = c.last_id; });
+  } catch (e) { console.error('Falha ao carregar não lidas:', e); }
   renderRooms();
   renderDMs();
 }
@@ -182,7 +288,8 @@ function connectSocket() {
 
   // conecta direto no seu IP
   const s = io(API_ROOT_URL, {
-    auth: { token },
+    // função: reavaliada a cada reconexão, levando o último id visto
+    auth: (cb) => cb({ token, lastSeenId: lastSeenId || null, format: useMsgpack ? 'msgpack' : 'json' }),
     transports: ['websocket', 'polling'],
     reconnection: true,
     reconnectionAttempts: 10,
@@ -194,15 +301,45 @@ function connectSocket() {
   s.on('error', (err) => console.error('socket error:', err));
 
   s.on('presence:update', ({ active }) => { activeCountEl.textContent = String(active ?? 0); });
+  s.on('presence:room', ({ roomId, active: n }) => {
+    roomOnline[roomId] = n;
+    if (active?.type === 'room' && active.id === roomId) setActiveTitle();
+  });
 
-  s.on('message:new', (msg) => {
-    if (active?.type === 'room' && msg.type === 'room' && msg.room_id === active.id) appendMessage(msg);
-    if (active?.type === 'dm' && msg.type === 'dm') {
-      const pair = (msg.sender_id === active.id || msg.recipient_id === active.id);
-      if (pair) appendMessage(msg);
+  // com msgpack as mensagens chegam como um anexo binário; o resto é JSON
+  const decode = (data) => (data instanceof ArrayBuffer || ArrayBuffer.isView(data) ? decodeMsgpack(data) : data);
+
+  s.on('message:new', (data) => receiveMessage(decode(data)));
+
+  // mensagens perdidas enquanto o socket estava fora, em ordem
+  s.on('message:batch', (data) => {
+    const { messages, truncated } = decode(data);
+    messages.forEach(receiveMessage);
+    if (truncated) { // muita coisa: recarrega contadores e a conversa aberta
+      loadSidebar();
+      if (active) openConversation(active);
     }
   });
 
+  function receiveMessage(msg) {
+    if (recentIds.has(msg.id)) return;
+    recentIds.add(msg.id);
+    if (recentIds.size > 1000) recentIds.delete(recentIds.values().next().value);
+    if (msg.id > lastSeenId) lastSeenId = msg.id;
+    const conv = msg.type === 'room'
+      ? { type: 'room', id: msg.room_id }
+      : { type: 'dm', id: msg.sender_id === myId ? msg.recipient_id : msg.sender_id };
+    if (active?.type === conv.type && active.id === conv.id) {
+      appendMessage(msg);
+      if (msg.sender_id !== myId) scheduleMarkRead();
+    } else if (msg.sender_id !== myId) {
+      setUnread(conv.type, conv.id, (unread[conv.type][conv.id] || 0) + 1);
+    }
+  }
+
+  // outra aba do mesmo usuário leu a conversa
+  s.on('unread:update', ({ type, id, unread: n }) => setUnread(type, id, n));
+
   s.on('room:left', ({ roomId }) => {
     if (active?.type === 'room' && active.id === roomId) {
       active = null; setActiveTitle(); messageList.innerHTML = '';
@@ -229,6 +366,15 @@ clearImgBtn.addEventListener('click', () => {
   imgPreview.classList.add('d-none'); imgPreviewTag.src = '';
 });
 
+// servidor limitando a taxa: espera o retry_after e reenvia (poucas vezes)
+function sendMessage(payload, attempt = 0) {
+  socket.emit('message:send', payload, (ack) => {
+    if (ack?.code !== 'rate_limited') return;
+    if (attempt >= 3) { alert('Você está enviando rápido demais. Tente novamente.'); return; }
+    setTimeout(() => sendMessage(payload, attempt + 1), Math.ceil((ack.retry_after || 1) * 1000));
+  });
+}
+
 sendBtn.onclick = async () => {
   if (!active) return;
   if (!socket || !socket.connected) {
@@ -252,9 +398,9 @@ sendBtn.onclick = async () => {
   if (!content && !attachmentUrl) return;
 
   if (active.type === 'room') {
-    socket.emit('message:send', { type: 'room', roomId: active.id, content, attachmentUrl, attachmentType }, () => {});
+    sendMessage({ type: 'room', roomId: active.id, content, attachmentUrl, attachmentType });
   } else {
-    socket.emit('message:send', { type: 'dm', toUserId: active.id, content, attachmentUrl, attachmentType }, () => {});
+    sendMessage({ type: 'dm', toUserId: active.id, content, attachmentUrl, attachmentType });
   }
 
   msgInput.value = '';
@@ -311,13 +457,17 @@ leaveBtn.onclick = async () => {
 };
 
 // logout
-logoutBtn.onclick = () => { setToken(null); window.location.href = './auth.html'; };
+logoutBtn.onclick = async () => {
+  try { await api.logout(); } catch {} // revoga o token no servidor (melhor esforço)
+  setToken(null); window.location.href = './auth.html';
+};
 
 // boot
 (async function init() {
   try {
     const me = await api.me();
     userNameEl.textContent = `Olá, ${me.name}`;
+    myId = me.id;
   } catch {
     setToken(null); window.location.href = './auth.html'; return;
   }
@@ -0,0 +1,83 @@
+// Decodificador MessagePack mínimo (só leitura), para os payloads binários do socket.
+// Cobre todos os tipos do formato exceto ext/timestamp, que o servidor não envia.
+
+const utf8 = new TextDecoder();
+
+export function decode(data) {
+  const bytes = data instanceof Uint8Array
+    ? data
+    : ArrayBuffer.isView(data)
+      ? new Uint8Array(data.buffer, data.byteOffset, data.byteLength)
+      : new Uint8Array(data);
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  let pos = 0;
+
+  function str(n) {
+    const s = utf8.decode(bytes.subarray(pos, pos + n));
+    pos += n;
+    return s;
+  }
+  function bin(n) {
+    const b = bytes.slice(pos, pos + n);
+    pos += n;
+    return b;
+  }
+  function array(n) {
+    const out = new Array(n);
+    for (let i = 0; i < n; i++) out[i] = read();
+    return out;
+  }
+  function map(n) {
+    const out = {};
+    for (let i = 0; i < n; i++) {
+      const k = read();
+      out[k] = read();
+    }
+    return out;
+  }
+  function u8() { return view.getUint8(pos++); }
+  function u16() { const v = view.getUint16(pos); pos += 2; return v; }
+  function u32() { const v = view.getUint32(pos); pos += 4; return v; }
+  function u64() { const v = view.getBigUint64(pos); pos += 8; return Number(v); }
+  function i64() { const v = view.getBigInt64(pos); pos += 8; return Number(v); }
+
+  function read() {
+    const t = u8();
+    if (t <= 0x7f) return t;                       // positive fixint
+    if (t <= 0x8f) return map(t & 0x0f);           // fixmap
+    if (t <= 0x9f) return array(t & 0x0f);         // fixarray
+    if (t <= 0xbf) return str(t & 0x1f);           // fixstr
+    if (t >= 0xe0) return t - 0x100;               // negative fixint
+    let v;
+    switch (t) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return bin(u8());
+      case 0xc5: return bin(u16());
+      case 0xc6: return bin(u32());
+      case 0xca: v = view.getFloat32(pos); pos += 4; return v;
+      case 0xcb: v = view.getFloat64(pos); pos += 8; return v;
+      case 0xcc: return u8();
+      case 0xcd: return u16();
+      case 0xce: return u32();
+      case 0xcf: return u64();
+      case 0xd0: v = view.getInt8(pos); pos += 1; return v;
+      case 0xd1: v = view.getInt16(pos); pos += 2; return v;
+      case 0xd2: v = view.getInt32(pos); pos += 4; return v;
+      case 0xd3: return i64();
+      case 0xd9: return str(u8());
+      case 0xda: return str(u16());
+      case 0xdb: return str(u32());
+      case 0xdc: return array(u16());
+      case 0xdd: return array(u32());
+      case 0xde: return map(u16());
+      case 0xdf: return map(u32());
+      default: throw new Error(`msgpack: tipo 0x${t.toString(16)} não suportado`);
+    }
+  }
+
+  const value = read();
+  if (pos !== bytes.length) throw new Error('msgpack: bytes sobrando no payload');
+  return value;
+}